@@ -0,0 +1,198 @@
+"""Check how queries are routed across data tiers, using two tiny generated tiers.
+
+    uv run python scripts/check_tiers.py
+
+Fails with an AssertionError if routing breaks any of its rules: each location and date is read from the
+first tier that covers it, no day is read from more than one tier, and days available from several tiers
+are only counted once by `TierRegistry.availability`.
+"""
+
+import datetime as dt
+import logging
+import os
+import tempfile
+from pathlib import Path
+
+import geopandas as gpd
+import polars as pl
+import pyarrow.parquet as pq
+from shapely.geometry import box
+
+VERSION = "vPUB2025"
+N_MODELS = 2
+
+
+def day(d: int) -> dt.date:
+    return dt.date(2024, 1, d)
+
+
+def write_location_tier(
+    pth: Path, coverage: dict[str, tuple[int, int]], value: float
+) -> None:
+    """One file per fold, partitioned by location, like /data/flow."""
+    for fold in range(N_MODELS):
+        dat = pl.DataFrame(
+            [
+                {
+                    "location": loc,
+                    "date": day(d),
+                    "value": value,
+                    "version": VERSION,
+                    "model_no": fold,
+                }
+                for loc, (start, end) in coverage.items()
+                for d in range(start, end + 1)
+            ],
+            schema={
+                "location": pl.String,
+                "date": pl.Date,
+                "value": pl.Float64,
+                "version": pl.String,
+                "model_no": pl.Int32,
+            },
+        )
+        pq.write_to_dataset(
+            dat.to_arrow(),
+            pth,
+            partition_cols=["location", "version"],
+            basename_template=f"fold={fold:02d}-{{i}}",
+        )
+
+
+def write_date_tier(
+    pth: Path, coverage: dict[str, tuple[int, int]], value: float
+) -> None:
+    """The whole ensemble in one file per date, like /data/current with --ensemble."""
+    dat = pl.DataFrame(
+        [
+            {
+                "location": loc,
+                "date": day(d),
+                "values": [value] * N_MODELS,
+                "version": VERSION,
+            }
+            for loc, (start, end) in coverage.items()
+            for d in range(start, end + 1)
+        ],
+        schema={
+            "location": pl.String,
+            "date": pl.Date,
+            "values": pl.Array(pl.Float64, N_MODELS),
+            "version": pl.String,
+        },
+    )
+    pq.write_to_dataset(
+        dat.to_arrow(),
+        pth,
+        partition_cols=["date", "version"],
+        basename_template="ensemble-{i}",
+    )
+
+
+def main(root: Path) -> None:
+    # streamflow_ml.db opens its datasets on import, so give it an empty one to open.
+    for name in ("flow", "current"):
+        (root / "empty" / name).mkdir(parents=True)
+    gpd.GeoDataFrame(
+        {"location": ["a"], "area": [1.0]}, geometry=[box(0, 0, 1, 1)], crs="EPSG:4326"
+    ).to_file(root / "empty" / "basins.geojson", driver="GeoJSON")
+    os.environ["SFML_DATA_DIR"] = str(root / "empty")
+    logging.disable(logging.WARNING)
+
+    from streamflow_ml.api import crud
+    from streamflow_ml.db import ParquetConn, TierRegistry, index_path
+
+    # "a" is in both tiers, overlapping on the 5th to the 10th. "b" is only in the second, "c" only in the first.
+    write_location_tier(root / "first", {"a": (1, 10), "c": (1, 3)}, value=1.0)
+    write_date_tier(root / "second", {"a": (5, 15), "b": (1, 15)}, value=2.0)
+    first = ParquetConn(root / "first", n_models=N_MODELS)
+    second = ParquetConn(root / "second", n_models=N_MODELS)
+    registry = TierRegistry(first, second)
+
+    routes = registry.route(["a", "b", "c"], VERSION, day(1), day(31))
+    assert [tier for tier, _ in routes] == [first, second]
+    assert routes[0][1] == {((day(1), day(10)),): ["a"], ((day(1), day(3)),): ["c"]}
+    assert routes[1][1] == {((day(11), day(15)),): ["a"], ((day(1), day(15)),): ["b"]}
+
+    # A later tier gets what is left on either side of an earlier one.
+    write_location_tier(root / "wide", {"a": (1, 31)}, value=3.0)
+    wide = ParquetConn(root / "wide", n_models=N_MODELS)
+    assert TierRegistry(second, wide).route(["a"], VERSION, day(1), day(31)) == [
+        (second, {((day(5), day(15)),): ["a"]}),
+        (wide, {((day(1), day(4)), (day(16), day(31))): ["a"]}),
+    ]
+
+    # A range entirely inside the first tier never touches the second.
+    routes = registry.route(["a"], VERSION, day(6), day(8))
+    assert [(tier, pieces) for tier, pieces in routes] == [
+        (first, {((day(6), day(8)),): ["a"]})
+    ]
+
+    # Reading through the routes returns every day once, from the first tier that has it.
+    for ensemble in (False, True):
+        dat = pl.concat(
+            [
+                frame.collect()
+                for frame in crud.scan_tiers(
+                    registry, ["a", "b", "c"], VERSION, day(1), day(31), ensemble
+                )
+            ],
+            how="diagonal_relaxed",
+        )
+        keys = ["location", "date"] if ensemble else ["location", "date", "model_no"]
+        assert not dat.select(keys).is_duplicated().any()
+        days = dat.group_by("location").agg(pl.col("date").n_unique()).sort("location")
+        assert days.rows() == [("a", 15), ("b", 15), ("c", 3)]
+        value = pl.col("values").list.first() if ensemble else pl.col("value")
+        from_first = dat.filter(pl.col("location") == "a", pl.col("date") <= day(10))
+        assert from_first.select((value == 1.0).all()).item()
+
+    # Overlapping days are only counted once.
+    availability = registry.availability(["a", "b", "c"], VERSION)
+    assert availability.select("location", "min_date", "max_date", "n_rows").rows() == [
+        ("a", day(1), day(15), 15),
+        ("b", day(1), day(15), 15),
+        ("c", day(1), day(3), 3),
+    ]
+
+    # A tier without any data is skipped, both when routing and when finding the latest date.
+    (root / "none").mkdir()
+    empty = ParquetConn(root / "none", n_models=N_MODELS)
+    registry = TierRegistry(empty, first, second)
+    assert [tier for tier, _ in registry.route(["a"], VERSION, day(1), day(31))] == [
+        first,
+        second,
+    ]
+    assert crud.get_latest_date(registry) == day(15)
+    assert crud.get_latest_date(TierRegistry(empty)) is None
+
+    # An index copied over ahead of its partitions is limited to the dates and locations on disk.
+    stale = pl.DataFrame(
+        {
+            "location": ["a", "d"],
+            "version": [VERSION, VERSION],
+            "min_date": [day(1), day(1)],
+            "max_date": [day(20), day(20)],
+            "n_rows": [20, 20],
+        }
+    )
+    stale.write_parquet(index_path(root / "first"))
+    stale.write_parquet(index_path(root / "second"))
+    first = ParquetConn(root / "first", n_models=N_MODELS)
+    second = ParquetConn(root / "second", n_models=N_MODELS)
+    assert first.availability().select("location", "max_date").rows() == [
+        ("a", day(20))
+    ]
+    assert second.availability().sort("location").select(
+        "location", "min_date", "max_date", "n_rows"
+    ).rows() == [
+        ("a", day(1), day(15), 15),
+        ("d", day(1), day(15), 15),
+    ]
+
+    print("Tier routing checks passed.")
+
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as tmp:
+        main(Path(tmp))
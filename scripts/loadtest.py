@@ -0,0 +1,680 @@
+"""Load test the API against a generated local dataset.
+
+    uv run python scripts/loadtest.py run --mix latest-heavy --clients 50 --duration 60
+
+The real app is started under uvicorn in a separate process, pointed at a synthetic stand-in for /data
+(generated on first use with the same partitioning code as production). Closed-loop clients replay a traffic
+mix while the server records event-loop lag and samples the stacks of all of its threads. Results are written
+to `--out`:
+
+- requests.csv: every request with its start time, kind, status, latency and response size.
+- timeline.csv: throughput, error rate, latency percentiles and loop lag per `--window` seconds.
+- loop_lag.csv: how late each of the server's event-loop ticks ran.
+- profile.folded: sampled stacks in folded format, for flamegraph.pl or speedscope.
+- summary.json: the same numbers as the printed report.
+"""
+
+import argparse
+import asyncio
+import collections
+import datetime as dt
+import json
+import math
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+import geopandas as gpd
+import httpx
+import numpy as np
+import polars as pl
+from shapely.geometry import box
+
+# Both live next to this script, which puts them on the path.
+import partition
+import partition_latest
+
+
+VERSION = "vPUB2025"
+N_MODELS = 10
+BASIN_SIZE = 0.25  # degrees
+
+# Relative weights of each kind of request.
+MIXES = {
+    # Map front ends polling the latest conditions, with the odd click through to a basin.
+    "latest-heavy": {"latest": 0.8, "point": 0.15, "availability": 0.05},
+    # Single basins over short windows, by ID and by coordinates.
+    "point": {"point": 0.5, "point-latlon": 0.2, "raw": 0.2, "availability": 0.1},
+    # Whole-record downloads of several basins at once.
+    "bulk": {"bulk": 0.5, "raw-bulk": 0.1, "point": 0.4},
+}
+
+# Leaf frames in these files are threads waiting for work rather than doing any.
+IDLE_FILES = ("selectors.py", "threading.py", "queue.py")
+
+
+def generate_dataset(
+    data_dir: Path, n_basins: int, n_years: int, ensemble: bool = False, seed: int = 0
+) -> None:
+    """Write basin boundaries and synthetic k-fold model output, then partition the output into a
+    location-partitioned history and a date-partitioned current year like /data."""
+    rng = np.random.default_rng(seed)
+    today = dt.date.today()
+    this_year = dt.date(today.year, 1, 1)
+
+    locations = [f"10{i:08d}" for i in range(n_basins)]
+    side = math.ceil(math.sqrt(n_basins))
+    boundaries = gpd.GeoDataFrame(
+        {"location": locations, "name": [f"Basin {i}" for i in range(n_basins)]},
+        geometry=[
+            box(
+                -116 + BASIN_SIZE * (i % side),
+                44 + BASIN_SIZE * (i // side),
+                -116 + BASIN_SIZE * (i % side + 1),
+                44 + BASIN_SIZE * (i // side + 1),
+            )
+            for i in range(n_basins)
+        ],
+        crs="EPSG:4326",
+    )
+    boundaries["area"] = boundaries.to_crs("EPSG:5070").area
+    data_dir.mkdir(parents=True, exist_ok=True)
+    boundaries.to_file(data_dir / "basins.geojson", driver="GeoJSON")
+
+    dates = pl.date_range(
+        dt.date(today.year - n_years, 1, 1),
+        max(today - dt.timedelta(days=2), this_year),
+        eager=True,
+    )
+    doy = dates.dt.ordinal_day().to_numpy()
+    # A snowmelt peak in early summer, scaled differently for each basin.
+    seasonal = 1 + 4 * np.exp(-(((doy - 160) / 30) ** 2))
+    scale = rng.uniform(0.2, 2, n_basins)
+
+    raw = data_dir / "raw"
+    for name in ("history", "current"):
+        (raw / name).mkdir(parents=True, exist_ok=True)
+    for fold in range(N_MODELS):
+        values = np.outer(scale, seasonal) * rng.gamma(4, 0.25, (n_basins, len(dates)))
+        out = pl.DataFrame(
+            {
+                "basin_id": np.repeat(locations, len(dates)),
+                "time": np.tile(dates.to_numpy(), n_basins),
+                "mm_d": values.ravel(),
+            }
+        )
+        out.filter(pl.col("time") < this_year).write_parquet(
+            raw / "history" / f"kfold-{fold:02d}-out.parquet"
+        )
+        # partition_latest.py keeps only the current year itself.
+        out.write_parquet(raw / "current" / f"kfold-{fold:02d}-out.parquet")
+
+    if ensemble:
+        partition.create_ensemble_partition(raw / "history", data_dir / "flow", VERSION)
+        partition_latest.create_ensemble_partition(
+            raw / "current", data_dir / "current", VERSION
+        )
+    else:
+        partition.create_hive_partition(raw / "history", data_dir / "flow", VERSION)
+        partition_latest.create_hive_partition(
+            raw / "current", data_dir / "current", VERSION
+        )
+    partition.write_index(data_dir / "flow")
+    partition_latest.write_index(data_dir / "current")
+
+
+class LoopLagMonitor:
+    """Measure how much later than scheduled the event loop wakes up a sleeping task. Anything that blocks
+    the loop, like synchronous polars or geopandas calls in a request handler, shows up as lag.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.samples: list[tuple[float, float]] = []
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(loop.time() - start - self.interval, 0.0)
+            self.samples.append((time.time(), lag))
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    path = "/".join(Path(code.co_filename).parts[-3:])
+    return f"{code.co_name} ({path}:{code.co_firstlineno})"
+
+
+class SamplingProfiler:
+    """Record the Python stack of every other thread at a fixed interval. Stacks are kept as folded strings,
+    rooted at the thread name, with a count of how often each was seen."""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.stacks: collections.Counter[str] = collections.Counter()
+        self.n_samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="sampler", daemon=True)
+
+    def _run(self) -> None:
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[";".join(reversed(stack))] += 1
+            self.n_samples += 1
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def write(self, pth: Path) -> None:
+        with open(pth, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+def serve(args: argparse.Namespace) -> None:
+    import uvicorn
+
+    from streamflow_ml import db
+    from streamflow_ml.api.main import app
+
+    if args.refresh_interval is not None:
+        for tier in db.tiers.tiers:
+            tier.refresh_interval = args.refresh_interval
+
+    lag = LoopLagMonitor(args.lag_interval)
+    profiler = SamplingProfiler(args.sample_interval)
+    server = uvicorn.Server(
+        uvicorn.Config(
+            app, host="127.0.0.1", port=args.port, log_level="warning", access_log=False
+        )
+    )
+
+    async def main():
+        monitor = asyncio.create_task(lag.run())
+        await server.serve()
+        monitor.cancel()
+
+    profiler.start()
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        # uvicorn re-raises the SIGINT used to stop it once it has shut down.
+        pass
+    finally:
+        profiler.stop()
+        profiler.write(args.out / "profile.folded")
+        pl.DataFrame(lag.samples, schema=["time", "lag_s"], orient="row").write_csv(
+            args.out / "loop_lag.csv"
+        )
+
+
+class Workload:
+    """Builds requests for each kind of traffic from what the server says is available."""
+
+    def __init__(
+        self, availability: dict, boundaries: gpd.GeoDataFrame, rng: random.Random
+    ):
+        self.rng = rng
+        self.locations = availability["location"]
+        self.date_start = dt.date.fromisoformat(min(availability["date_start"]))
+        self.date_end = dt.date.fromisoformat(max(availability["date_end"]))
+        centroids = boundaries.set_index("location").geometry.representative_point()
+        self.centroids = {loc: (p.y, p.x) for loc, p in centroids.items()}
+
+    def _window(self, days: int) -> dict[str, str]:
+        span = max((self.date_end - self.date_start).days - days, 0)
+        start = self.date_start + dt.timedelta(days=self.rng.randint(0, span))
+        return {
+            "date_start": start.isoformat(),
+            "date_end": min(start + dt.timedelta(days=days), self.date_end).isoformat(),
+        }
+
+    def latest(self) -> tuple[str, dict]:
+        aggregations = self.rng.choice(
+            [["median"], ["median", "iqr"], ["min", "median", "max"]]
+        )
+        return "/predictions/latest", {
+            "aggregations": ",".join(aggregations),
+            "as_csv": str(self.rng.random() < 0.2).lower(),
+        }
+
+    def point(self) -> tuple[str, dict]:
+        return "/predictions", {
+            "locations": self.rng.choice(self.locations),
+            **self._window(30),
+        }
+
+    def point_latlon(self) -> tuple[str, dict]:
+        latitude, longitude = self.centroids[self.rng.choice(self.locations)]
+        return "/predictions", {
+            "latitude": latitude,
+            "longitude": longitude,
+            **self._window(30),
+        }
+
+    def raw(self) -> tuple[str, dict]:
+        return "/predictions/raw", {
+            "locations": self.rng.choice(self.locations),
+            "layout": self.rng.choice(["long", "wide"]),
+            **self._window(30),
+        }
+
+    def bulk(self) -> tuple[str, dict]:
+        # Comma separated, so the query-string flattening middleware is exercised too.
+        locations = self.rng.sample(
+            self.locations, min(self.rng.randint(5, 20), len(self.locations))
+        )
+        return "/predictions", {
+            "locations": ",".join(locations),
+            "aggregations": "mean,median",
+            "as_csv": str(self.rng.random() < 0.5).lower(),
+        }
+
+    def raw_bulk(self) -> tuple[str, dict]:
+        locations = self.rng.sample(self.locations, min(5, len(self.locations)))
+        return "/predictions/raw", {"locations": ",".join(locations), "layout": "wide"}
+
+    def availability(self) -> tuple[str, dict]:
+        return "/availability", {"locations": self.rng.choice(self.locations)}
+
+    def build(self, kind: str) -> tuple[str, dict]:
+        return getattr(self, kind.replace("-", "_"))()
+
+
+def parse_mix(mix: str) -> dict[str, float]:
+    """A named mix, or custom weights like `latest=8,bulk=1`."""
+    if mix in MIXES:
+        return MIXES[mix]
+    weights = {}
+    for part in mix.split(","):
+        kind, _, weight = part.partition("=")
+        if not hasattr(Workload, kind.replace("-", "_")):
+            raise argparse.ArgumentTypeError(f"Unknown request kind: {kind}")
+        weights[kind] = float(weight or 1)
+    return weights
+
+
+async def client(
+    http: httpx.AsyncClient,
+    workload: Workload,
+    mix: dict[str, float],
+    t0: float,
+    deadline: float,
+    think_time: float,
+    records: list[tuple],
+) -> None:
+    kinds, weights = list(mix), list(mix.values())
+    while time.perf_counter() < deadline:
+        kind = workload.rng.choices(kinds, weights)[0]
+        path, params = workload.build(kind)
+        start = time.perf_counter()
+        try:
+            r = await http.get(path, params=params)
+            status, size, error = r.status_code, len(r.content), None
+        except httpx.HTTPError as e:
+            status, size, error = None, 0, type(e).__name__
+        records.append(
+            (
+                start - t0,
+                kind,
+                status,
+                (time.perf_counter() - start) * 1000,
+                size,
+                error,
+            )
+        )
+        if think_time:
+            await asyncio.sleep(workload.rng.expovariate(1 / think_time))
+
+
+async def drive(
+    args: argparse.Namespace, base_url: str, mix: dict[str, float]
+) -> list[tuple]:
+    limits = httpx.Limits(
+        max_connections=args.clients, max_keepalive_connections=args.clients
+    )
+    async with httpx.AsyncClient(
+        base_url=base_url, timeout=args.timeout, limits=limits
+    ) as http:
+        r = await http.get("/availability", params={"version": VERSION})
+        r.raise_for_status()
+        boundaries = gpd.read_file(args.data_dir / "basins.geojson")
+        workload = Workload(r.json(), boundaries, random.Random(args.seed))
+
+        records = []
+        t0 = time.perf_counter()
+        deadline = t0 + args.duration
+
+        async def ramped(i: int):
+            await asyncio.sleep(args.ramp * i / args.clients)
+            await client(http, workload, mix, t0, deadline, args.think_time, records)
+
+        await asyncio.gather(*(ramped(i) for i in range(args.clients)))
+    return records
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _wait_until_up(base_url: str, proc: subprocess.Popen, timeout: float = 120) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(
+                f"The server exited with code {proc.returncode} before starting."
+            )
+        try:
+            httpx.get(f"{base_url}/metrics", timeout=1).raise_for_status()
+            return
+        except httpx.HTTPError:
+            time.sleep(0.5)
+    raise TimeoutError(f"The server did not start within {timeout} seconds.")
+
+
+def _latency_stats() -> list[pl.Expr]:
+    return [
+        pl.len().alias("requests"),
+        (
+            pl.col("status").is_null()
+            | ((pl.col("status") >= 400) & (pl.col("status") != 429))
+        )
+        .sum()
+        .alias("errors"),
+        (pl.col("status") == 429).sum().alias("shed"),
+        *(
+            pl.col("latency_ms").quantile(q, "nearest").alias(f"p{int(q * 100)}_ms")
+            for q in (0.5, 0.95, 0.99)
+        ),
+        pl.col("latency_ms").max().alias("max_ms"),
+    ]
+
+
+def report(args: argparse.Namespace, records: list[tuple], t_start: float) -> dict:
+    requests = pl.DataFrame(
+        records,
+        schema={
+            "t": pl.Float64,
+            "kind": pl.String,
+            "status": pl.Int64,
+            "latency_ms": pl.Float64,
+            "bytes": pl.Int64,
+            "error": pl.String,
+        },
+        orient="row",
+    ).sort("t")
+    requests.write_csv(args.out / "requests.csv")
+
+    lag = pl.read_csv(
+        args.out / "loop_lag.csv", schema={"time": pl.Float64, "lag_s": pl.Float64}
+    )
+    lag = lag.select(t=pl.col("time") - t_start, lag_ms=pl.col("lag_s") * 1000).filter(
+        pl.col("t").is_between(0, args.duration)
+    )
+
+    window = pl.col("t") // args.window * args.window
+    timeline = (
+        requests.group_by(window.alias("window_s"))
+        .agg(_latency_stats())
+        .join(
+            lag.group_by(window.alias("window_s")).agg(
+                pl.col("lag_ms").quantile(0.99, "nearest").alias("lag_p99_ms"),
+                pl.col("lag_ms").max().alias("lag_max_ms"),
+            ),
+            on="window_s",
+            how="full",
+            coalesce=True,
+        )
+        .with_columns(
+            rps=pl.col("requests") / args.window,
+            error_rate=pl.col("errors") / pl.col("requests"),
+        )
+        .sort("window_s")
+    )
+    timeline.write_csv(args.out / "timeline.csv")
+
+    measured = requests.filter(pl.col("t") >= args.warmup)
+    by_kind = measured.group_by("kind").agg(_latency_stats()).sort("kind")
+    overall = measured.select(_latency_stats())
+
+    # Self time of the innermost frames, and total time under each of the app's own functions.
+    leaves, app_frames = collections.Counter(), collections.Counter()
+    busy = 0
+    for line in (args.out / "profile.folded").read_text().splitlines():
+        stack, count = line.rsplit(" ", 1)
+        frames = stack.split(";")
+        if frames[-1].split(" (")[1].split(":")[0].endswith(IDLE_FILES):
+            continue
+        busy += int(count)
+        leaves[frames[-1]] += int(count)
+        for frame in set(frames[1:]):
+            if "streamflow_ml/" in frame:
+                app_frames[frame] += int(count)
+
+    summary = {
+        "mix": args.mix,
+        "clients": args.clients,
+        "duration_s": args.duration,
+        "warmup_s": args.warmup,
+        "rps": overall["requests"][0] / max(args.duration - args.warmup, 1e-9),
+        "overall": overall.to_dicts()[0],
+        "by_kind": by_kind.to_dicts(),
+        "loop_lag_ms": lag.filter(pl.col("t") >= args.warmup)
+        .select(
+            p50=pl.col("lag_ms").quantile(0.5, "nearest"),
+            p99=pl.col("lag_ms").quantile(0.99, "nearest"),
+            max=pl.col("lag_ms").max(),
+        )
+        .to_dicts()[0],
+        "profile_busy_samples": busy,
+        "profile_self": [
+            {"frame": frame, "samples": count, "share": count / busy}
+            for frame, count in leaves.most_common(args.top)
+        ],
+        "profile_app": [
+            {"frame": frame, "samples": count, "share": count / busy}
+            for frame, count in app_frames.most_common(args.top)
+        ],
+    }
+    (args.out / "summary.json").write_text(json.dumps(summary, indent=2, default=str))
+
+    with pl.Config(
+        tbl_rows=-1, tbl_cols=-1, tbl_width_chars=200, tbl_hide_dataframe_shape=True
+    ):
+        print(f"\n{args.mix}: {args.clients} clients, {summary['rps']:.1f} requests/s")
+        print(by_kind)
+        print(f"Event loop lag (ms): {summary['loop_lag_ms']}")
+        print(f"\nSelf time across {busy} busy thread samples:")
+        for row in summary["profile_self"]:
+            print(f"{row['share']:6.1%}  {row['frame']}")
+        print("\nTotal time under the app's functions:")
+        for row in summary["profile_app"]:
+            print(f"{row['share']:6.1%}  {row['frame']}")
+        print(f"\nResults written to {args.out}")
+    return summary
+
+
+def run(args: argparse.Namespace) -> None:
+    if args.regenerate or not (args.data_dir / "basins.geojson").exists():
+        generate_dataset(
+            args.data_dir, args.basins, args.years, args.ensemble, args.seed
+        )
+    args.out.mkdir(parents=True, exist_ok=True)
+    mix = parse_mix(args.mix)
+
+    port = _free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    cmd = [
+        sys.executable,
+        __file__,
+        "serve",
+        "--port",
+        str(port),
+        "--out",
+        str(args.out),
+        "--lag-interval",
+        str(args.lag_interval),
+        "--sample-interval",
+        str(args.sample_interval),
+    ]
+    if args.refresh_interval is not None:
+        cmd += ["--refresh-interval", str(args.refresh_interval)]
+    proc = subprocess.Popen(
+        cmd, env={**os.environ, "SFML_DATA_DIR": str(args.data_dir.resolve())}
+    )
+    try:
+        _wait_until_up(base_url, proc)
+        t_start = time.time()
+        records = asyncio.run(drive(args, base_url, mix))
+    finally:
+        proc.send_signal(signal.SIGINT)
+        proc.wait()
+    report(args, records, t_start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Load test the API against a generated local dataset."
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    def add_data_args(p: argparse.ArgumentParser) -> None:
+        p.add_argument(
+            "--data-dir",
+            type=Path,
+            default=Path("loadtest-data"),
+            help="Where the generated dataset lives.",
+        )
+        p.add_argument(
+            "--basins", type=int, default=500, help="Number of basins to generate."
+        )
+        p.add_argument(
+            "--years",
+            type=int,
+            default=5,
+            help="Years of history before the current year.",
+        )
+        p.add_argument(
+            "--ensemble",
+            action="store_true",
+            help="Partition with the ensemble layout instead of one file per fold.",
+        )
+        p.add_argument("--seed", type=int, default=0)
+
+    def add_server_args(p: argparse.ArgumentParser) -> None:
+        p.add_argument(
+            "--lag-interval",
+            type=float,
+            default=0.01,
+            help="Seconds between event-loop lag probes.",
+        )
+        p.add_argument(
+            "--sample-interval",
+            type=float,
+            default=0.005,
+            help="Seconds between profiler samples.",
+        )
+        p.add_argument(
+            "--refresh-interval",
+            type=float,
+            default=None,
+            help="Override how often the data is rescanned, in seconds.",
+        )
+
+    generate = subparsers.add_parser("generate", help="Only generate the dataset.")
+    add_data_args(generate)
+
+    run_parser = subparsers.add_parser(
+        "run", help="Start the server and replay a traffic mix against it."
+    )
+    add_data_args(run_parser)
+    add_server_args(run_parser)
+    run_parser.add_argument(
+        "--regenerate",
+        action="store_true",
+        help="Generate the dataset even if it already exists.",
+    )
+    run_parser.add_argument(
+        "--mix",
+        default="latest-heavy",
+        help=f"One of {', '.join(MIXES)}, or weights like `latest=8,bulk=1`.",
+    )
+    run_parser.add_argument(
+        "--clients", type=int, default=50, help="Number of concurrent clients."
+    )
+    run_parser.add_argument(
+        "--duration", type=float, default=60, help="Seconds to run for."
+    )
+    run_parser.add_argument(
+        "--warmup",
+        type=float,
+        default=5,
+        help="Seconds at the start left out of the summary.",
+    )
+    run_parser.add_argument(
+        "--ramp", type=float, default=5, help="Seconds over which clients are started."
+    )
+    run_parser.add_argument(
+        "--think-time",
+        type=float,
+        default=0,
+        help="Mean pause between a client's requests, in seconds.",
+    )
+    run_parser.add_argument(
+        "--timeout", type=float, default=60, help="Request timeout in seconds."
+    )
+    run_parser.add_argument(
+        "--window", type=float, default=5, help="Seconds per row of the timeline."
+    )
+    run_parser.add_argument(
+        "--top", type=int, default=20, help="Number of profiled frames to print."
+    )
+    run_parser.add_argument(
+        "--out",
+        type=Path,
+        default=None,
+        help="Results directory (default: loadtest-results/<mix>-<time>).",
+    )
+
+    serve_parser = subparsers.add_parser("serve", help=argparse.SUPPRESS)
+    add_server_args(serve_parser)
+    serve_parser.add_argument("--port", type=int, required=True)
+    serve_parser.add_argument("--out", type=Path, required=True)
+
+    args = parser.parse_args()
+    if args.command == "generate":
+        generate_dataset(
+            args.data_dir, args.basins, args.years, args.ensemble, args.seed
+        )
+    elif args.command == "serve":
+        serve(args)
+    else:
+        if args.out is None:
+            args.out = (
+                Path("loadtest-results")
+                / f"{args.mix}-{dt.datetime.now():%Y%m%dT%H%M%S}"
+            )
+        run(args)
@@ -1,13 +1,19 @@
 import polars as pl
 from pathlib import Path
 import pyarrow.parquet as pq
+import datetime as dt
+import os
+import re
 
 
-def parse_observations(
-    data: Path | str, version: str = "v1.0", model_no: int = 0
-) -> pl.DataFrame:
-    return (
-        pl.read_parquet(data)
+def scan_observations(
+    data: Path | str,
+    version: str = "v1.0",
+    model_no: int = 0,
+    date_start: dt.date | None = None,
+) -> pl.LazyFrame:
+    dat = (
+        pl.scan_parquet(data)
         .select(["basin_id", "time", "mm_d"])
         .rename(
             {
@@ -23,13 +29,95 @@ def parse_observations(
             ]
         )
     )
+    if date_start is not None:
+        dat = dat.filter(pl.col("date") >= date_start)
+    return dat
+
+
+def parse_observations(
+    data: Path | str,
+    version: str = "v1.0",
+    model_no: int = 0,
+    date_start: dt.date | None = None,
+) -> pl.DataFrame:
+    return scan_observations(data, version, model_no, date_start).collect()
+
+
+def basename_prefix(tag: str | None) -> str:
+    # Tagged files sit next to the existing ones in each partition instead of overwriting them.
+    return f"{tag}-" if tag else ""
+
+
+def fold_number(f: Path) -> int:
+    return int(f.name.split("-")[-2])
+
+
+def to_ensemble(dat: pl.LazyFrame, n_models: int) -> pl.LazyFrame:
+    # One slot per model, so a missing fold leaves a null instead of shifting the models after it.
+    model_cols = [f"model_{i}" for i in range(n_models)]
+    return (
+        dat.group_by("location", "version", "date")
+        .agg(
+            pl.col("value").filter(pl.col("model_no") == i).first().alias(col)
+            for i, col in enumerate(model_cols)
+        )
+        .select(
+            "location",
+            "version",
+            "date",
+            pl.concat_list(model_cols).list.to_array(n_models).alias("values"),
+        )
+        .sort("location", "date")
+    )
+
+
+def create_ensemble_partition(
+    pth: Path,
+    out_pth: Path,
+    version: str,
+    date_start: dt.date | None = None,
+    tag: str | None = None,
+    chunk_size: int = 500,
+) -> None:
+    files = sorted(pth.iterdir(), key=fold_number)
+    # Folds are numbered from 0, so this holds even if a fold in between is missing.
+    n_models = fold_number(files[-1]) + 1
+    dat = pl.concat(
+        [scan_observations(f, version, fold_number(f), date_start) for f in files]
+    )
+    locations = (
+        dat.select(pl.col("location").unique().sort()).collect()["location"].to_list()
+    )
+
+    for i in range(0, len(locations), chunk_size):
+        chunk = locations[i : i + chunk_size]
+        print(f"Processing locations {i + 1}-{i + len(chunk)} of {len(locations)}")
+        ar = (
+            to_ensemble(dat.filter(pl.col("location").is_in(chunk)), n_models)
+            .collect()
+            .to_arrow()
+        )
+
+        pq.write_to_dataset(
+            ar,
+            out_pth,
+            partition_cols=["location", "version"],
+            existing_data_behavior="overwrite_or_ignore",
+            basename_template=f"ensemble-{basename_prefix(tag)}{{i}}",
+        )
 
 
-def create_hive_partition(pth: Path, out_pth: Path, version: str) -> None:
+def create_hive_partition(
+    pth: Path,
+    out_pth: Path,
+    version: str,
+    date_start: dt.date | None = None,
+    tag: str | None = None,
+) -> None:
     for f in pth.iterdir():
         print(f"Processing {f.name}")
-        fold = int(f.name.split("-")[-2])
-        dat = parse_observations(f, version, fold)
+        fold = fold_number(f)
+        dat = parse_observations(f, version, fold, date_start)
         ar = dat.to_arrow()
 
         pq.write_to_dataset(
@@ -37,8 +125,87 @@ def create_hive_partition(pth: Path, out_pth: Path, version: str) -> None:
             out_pth,
             partition_cols=["location", "version"],
             existing_data_behavior="overwrite_or_ignore",
-            basename_template=f"fold={fold:02d}-{{i}}",
+            basename_template=f"fold={fold:02d}-{basename_prefix(tag)}{{i}}",
+        )
+
+
+def remove_superseded(
+    pth: Path,
+    out_pth: Path,
+    version: str,
+    date_start: dt.date | None = None,
+    tag: str | None = None,
+) -> None:
+    """Delete files from other batches (see --tag) that only hold dates the batch just written from `pth`
+    also covers. Otherwise, e.g. after rolling a year in with a tag and later rebuilding without one, those
+    days would be in two batches and read twice."""
+    files = sorted(pth.iterdir(), key=fold_number)
+    coverage = (
+        pl.concat(
+            [scan_observations(f, version, fold_number(f), date_start) for f in files]
         )
+        .group_by("location", "version")
+        .agg(first=pl.col("date").min(), last=pl.col("date").max())
+        .collect()
+    )
+    written = re.compile(rf"(fold=\d+|ensemble)-{re.escape(basename_prefix(tag))}\d+")
+
+    for location, version, first, last in coverage.iter_rows():
+        for f in (out_pth / f"location={location}" / f"version={version}").iterdir():
+            if written.fullmatch(f.name):
+                continue
+            lo, hi = (
+                pl.scan_parquet(f)
+                .select(lo=pl.col("date").min(), hi=pl.col("date").max())
+                .collect()
+                .row(0)
+            )
+            if lo is None or hi < first or last < lo:
+                continue
+            if first <= lo and hi <= last:
+                print(f"Removing {f}, superseded by the new files")
+                f.unlink()
+            else:
+                print(
+                    f"Warning: {f} overlaps the new files but also holds other "
+                    "dates, so the overlapping days will be read twice. Rewrite or "
+                    "remove it by hand."
+                )
+
+
+def write_index(out_pth: Path) -> None:
+    """Record the first and last date and the number of days predicted for each location and version, so the
+    API can check availability without scanning the partitions. The index is written next to the dataset
+    rather than inside it (e.g. /data/flow_index.parquet for /data/flow)."""
+    index_file = out_pth.with_name(f"{out_pth.name}_index.parquet")
+    keys = [
+        pl.scan_parquet(
+            [str(f) for f in files],
+            hive_partitioning=True,
+            hive_schema={"location": pl.String, "version": pl.String},
+        ).select("location", "version", "date")
+        for files in (
+            list(out_pth.glob("*/*/fold=*")),
+            list(out_pth.glob("*/*/ensemble-*")),
+        )
+        if files
+    ]
+    (
+        pl.concat(keys)
+        .group_by("location", "version")
+        .agg(
+            min_date=pl.col("date").min(),
+            max_date=pl.col("date").max(),
+            n_rows=pl.col("date").n_unique(),
+        )
+        .sort("location", "version")
+        .collect()
+        .write_parquet(f"{index_file}.tmp")
+    )
+    # Swap the index in atomically so the API never reads a partially written one.
+    os.replace(f"{index_file}.tmp", index_file)
+    # Earlier versions wrote the index inside the dataset, where it breaks scanning the whole directory.
+    (out_pth / "_index.parquet").unlink(missing_ok=True)
 
 
 if __name__ == "__main__":
@@ -49,11 +216,42 @@ if __name__ == "__main__":
     parser.add_argument("pth", type=Path, help="Input directory path")
     parser.add_argument("out_pth", type=Path, help="Output directory path")
     parser.add_argument("version", type=str, help="Version string")
+    parser.add_argument(
+        "--ensemble",
+        action="store_true",
+        help=(
+            "Store each day's k-fold ensemble as a single fixed-size list column "
+            "instead of one file per fold."
+        ),
+    )
+    parser.add_argument(
+        "--date-start",
+        type=dt.date.fromisoformat,
+        default=None,
+        help="Only partition predictions on or after this date (YYYY-MM-DD).",
+    )
+    parser.add_argument(
+        "--tag",
+        type=str,
+        default=None,
+        help=(
+            "Added to the output file names so new data is written alongside "
+            "existing partitions, e.g. when rolling the current year into the "
+            "historical store."
+        ),
+    )
 
     args = parser.parse_args()
 
-    create_hive_partition(
+    partition = create_ensemble_partition if args.ensemble else create_hive_partition
+    partition(
         args.pth,
         args.out_pth,
         args.version,
+        args.date_start,
+        args.tag,
+    )
+    remove_superseded(
+        args.pth, args.out_pth, args.version, args.date_start, args.tag
     )
+    write_index(args.out_pth)
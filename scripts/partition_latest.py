@@ -11,6 +11,7 @@ import polars as pl
 from pathlib import Path
 import pyarrow.parquet as pq
 import datetime as dt
+import os
 
 
 def parse_observations(
@@ -38,10 +39,52 @@ def parse_observations(
     )
 
 
+def fold_number(f: Path) -> int:
+    return int(f.name.split("-")[-2])
+
+
+def to_ensemble(dat: pl.DataFrame, n_models: int) -> pl.DataFrame:
+    # One slot per model, so a missing fold leaves a null instead of shifting the models after it.
+    model_cols = [f"model_{i}" for i in range(n_models)]
+    return (
+        dat.group_by("location", "version", "date")
+        .agg(
+            pl.col("value").filter(pl.col("model_no") == i).first().alias(col)
+            for i, col in enumerate(model_cols)
+        )
+        .select(
+            "location",
+            "version",
+            "date",
+            pl.concat_list(model_cols).list.to_array(n_models).alias("values"),
+        )
+        .sort("date", "location")
+    )
+
+
+def create_ensemble_partition(pth: Path, out_pth: Path, version: str) -> None:
+    files = sorted(pth.iterdir(), key=fold_number)
+    # Folds are numbered from 0, so this holds even if a fold in between is missing.
+    n_models = fold_number(files[-1]) + 1
+    folds = []
+    for f in files:
+        print(f"Processing {f.name}")
+        folds.append(parse_observations(f, version, fold_number(f)))
+    ar = to_ensemble(pl.concat(folds), n_models).to_arrow()
+
+    pq.write_to_dataset(
+        ar,
+        out_pth,
+        partition_cols=["date", "version"],
+        existing_data_behavior="overwrite_or_ignore",
+        basename_template="ensemble-{i}",
+    )
+
+
 def create_hive_partition(pth: Path, out_pth: Path, version: str) -> None:
     for f in pth.iterdir():
         print(f"Processing {f.name}")
-        fold = int(f.name.split("-")[-2])
+        fold = fold_number(f)
         dat = parse_observations(f, version, fold)
         ar = dat.to_arrow()
 
@@ -54,6 +97,41 @@ def create_hive_partition(pth: Path, out_pth: Path, version: str) -> None:
         )
 
 
+def write_index(out_pth: Path) -> None:
+    """Record the first and last date and the number of days predicted for each location and version, so the
+    API can check availability without scanning the partitions. The index is written next to the dataset
+    rather than inside it (e.g. /data/flow_index.parquet for /data/flow)."""
+    index_file = out_pth.with_name(f"{out_pth.name}_index.parquet")
+    keys = [
+        pl.scan_parquet(
+            [str(f) for f in files],
+            hive_partitioning=True,
+            hive_schema={"date": pl.Date, "version": pl.String},
+        ).select("location", "version", "date")
+        for files in (
+            list(out_pth.glob("*/*/fold=*")),
+            list(out_pth.glob("*/*/ensemble-*")),
+        )
+        if files
+    ]
+    (
+        pl.concat(keys)
+        .group_by("location", "version")
+        .agg(
+            min_date=pl.col("date").min(),
+            max_date=pl.col("date").max(),
+            n_rows=pl.col("date").n_unique(),
+        )
+        .sort("location", "version")
+        .collect()
+        .write_parquet(f"{index_file}.tmp")
+    )
+    # Swap the index in atomically so the API never reads a partially written one.
+    os.replace(f"{index_file}.tmp", index_file)
+    # Earlier versions wrote the index inside the dataset, where it breaks scanning the whole directory.
+    (out_pth / "_index.parquet").unlink(missing_ok=True)
+
+
 if __name__ == "__main__":
     import argparse
 
@@ -65,12 +143,22 @@ if __name__ == "__main__":
         "out_dir", type=str, help="Output directory for partitioned current year data."
     )
     parser.add_argument(
-        "version", type=str, required=True, help="Version string (required)."
+        "version", type=str, help="Version string (required)."
+    )
+    parser.add_argument(
+        "--ensemble",
+        action="store_true",
+        help=(
+            "Store each day's k-fold ensemble as a single fixed-size list column "
+            "instead of one file per fold."
+        ),
     )
     args = parser.parse_args()
 
-    create_hive_partition(
+    partition = create_ensemble_partition if args.ensemble else create_hive_partition
+    partition(
         Path(args.pth),
         Path(args.out_dir),
         args.version,
     )
+    write_index(Path(args.out_dir))
@@ -1,4 +1,6 @@
 #/bin/bash
 
 uv run ./partition_latest.py /data/ssd2/streamflow-ml-data-operational/operational-output/current-k-fold/ /data/ssd2/streamflow-ml-data-operational/operational-output/current_partition vPUB2025
-rsync -ravz /data/ssd2/streamflow-ml-data-operational/operational-output/current_partition/ data.climate.umt.edu:/var/data/hhp/current
\ No newline at end of file
+rsync -ravz /data/ssd2/streamflow-ml-data-operational/operational-output/current_partition/ data.climate.umt.edu:/var/data/hhp/current
+# The index goes last, so the API never sees dates whose partitions haven't arrived yet.
+rsync -avz /data/ssd2/streamflow-ml-data-operational/operational-output/current_partition_index.parquet data.climate.umt.edu:/var/data/hhp/current_index.parquet
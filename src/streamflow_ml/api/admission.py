@@ -0,0 +1,141 @@
+import asyncio
+import heapq
+import itertools
+import os
+from contextlib import asynccontextmanager
+
+import polars as pl
+from fastapi.exceptions import HTTPException
+from streamflow_ml.api import schemas
+from streamflow_ml.db import N_MODELS
+
+# Costs are measured in ensemble rows read: one row per location, day and k-fold model.
+
+ADMISSION_BUDGET = int(os.getenv("SFML_ADMISSION_BUDGET", 20_000_000))
+ADMISSION_QUEUE_SIZE = int(os.getenv("SFML_ADMISSION_QUEUE_SIZE", 64))
+ADMISSION_RETRY_AFTER = int(os.getenv("SFML_ADMISSION_RETRY_AFTER", 5))
+
+
+def estimate_cost(
+    predictions: schemas.GetPredictionsRaw | schemas.GetPredictionsByLocations,
+    availability: pl.DataFrame,
+) -> int:
+    """Cost of a request, counting only the days each location actually has predictions for (as returned by
+    `crud.validate_predictions`)."""
+    n_days = availability.select(
+        (
+            pl.min_horizontal("date_end", pl.lit(predictions.date_end))
+            - pl.max_horizontal("date_start", pl.lit(predictions.date_start))
+        ).dt.total_days()
+        + 1
+    ).to_series()
+    return max(int(n_days.clip(lower_bound=0).sum()), 1) * N_MODELS
+
+
+class AdmissionController:
+    """Limit the total estimated cost of requests running at once. Requests that don't fit wait in a queue
+    ordered by cost, so cheap requests are admitted ahead of expensive ones. Once the queue is full, the most
+    expensive waiting request is rejected with a 429. A request costing more than the whole budget is admitted
+    when nothing else is running.
+    """
+
+    def __init__(
+        self,
+        budget: int = ADMISSION_BUDGET,
+        queue_size: int = ADMISSION_QUEUE_SIZE,
+        retry_after: int = ADMISSION_RETRY_AFTER,
+    ):
+        self.budget = budget
+        self.queue_size = queue_size
+        self.retry_after = retry_after
+        self.in_flight = 0
+        self.running = 0
+        self.admitted = 0
+        self.rejected = 0
+        self._queue: list[tuple[int, int, asyncio.Future]] = []
+        self._counter = itertools.count()
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(not fut.done() for _, _, fut in self._queue)
+
+    def _fits(self, cost: int) -> bool:
+        return self.running == 0 or self.in_flight + cost <= self.budget
+
+    def _start(self, cost: int) -> None:
+        self.in_flight += cost
+        self.running += 1
+        self.admitted += 1
+
+    def _release(self, cost: int) -> None:
+        self.in_flight -= cost
+        self.running -= 1
+        self._wake()
+
+    def _wake(self) -> None:
+        while self._queue:
+            cost, _, fut = self._queue[0]
+            if fut.done():
+                heapq.heappop(self._queue)
+                continue
+            if not self._fits(cost):
+                break
+            heapq.heappop(self._queue)
+            self._start(cost)
+            fut.set_result(None)
+
+    def _reject(self) -> HTTPException:
+        self.rejected += 1
+        return HTTPException(
+            status_code=429,
+            detail="The server is busy. Please retry the request later.",
+            headers={"Retry-After": str(self.retry_after)},
+        )
+
+    @asynccontextmanager
+    async def admit(self, cost: int):
+        cost = min(cost, self.budget)
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (cost, next(self._counter), fut))
+        self._wake()
+
+        if self.queue_depth > self.queue_size:
+            # Shed the most expensive waiting request, which may be this one.
+            _, _, shed = max(
+                (x for x in self._queue if not x[2].done()), key=lambda x: x[:2]
+            )
+            shed.set_exception(self._reject())
+
+        try:
+            await fut
+        except asyncio.CancelledError:
+            # The client went away. If we were admitted in the meantime, give the budget back.
+            if fut.done() and not fut.cancelled() and fut.exception() is None:
+                self._release(cost)
+            else:
+                fut.cancel()
+            raise
+
+        try:
+            yield
+        finally:
+            self._release(cost)
+
+    def metrics(self) -> str:
+        return "\n".join(
+            [
+                "# TYPE sfml_admission_queue_depth gauge",
+                f"sfml_admission_queue_depth {self.queue_depth}",
+                "# TYPE sfml_admission_running gauge",
+                f"sfml_admission_running {self.running}",
+                "# TYPE sfml_admission_in_flight_cost gauge",
+                f"sfml_admission_in_flight_cost {self.in_flight}",
+                "# TYPE sfml_admission_budget gauge",
+                f"sfml_admission_budget {self.budget}",
+                "# TYPE sfml_admission_admitted_total counter",
+                f"sfml_admission_admitted_total {self.admitted}",
+                "# TYPE sfml_admission_rejected_total counter",
+                f"sfml_admission_rejected_total {self.rejected}",
+                "",
+            ]
+        )
@@ -0,0 +1,283 @@
+import asyncio
+import os
+import zlib
+from collections import OrderedDict
+from typing import Awaitable, Callable, Hashable
+
+import anyio.to_thread
+from fastapi import Request, Response
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+MINIMUM_SIZE = int(os.getenv("SFML_COMPRESSION_MINIMUM_SIZE", 1024))
+
+# Levels used when compressing responses on the fly.
+LEVELS = {
+    "zstd": int(os.getenv("SFML_ZSTD_LEVEL", 3)),
+    "br": int(os.getenv("SFML_BROTLI_LEVEL", 4)),
+    "gzip": int(os.getenv("SFML_GZIP_LEVEL", 6)),
+}
+
+# Cached bodies are only compressed once, so they can afford a much higher level.
+PRECOMPRESS_LEVELS = {
+    "zstd": int(os.getenv("SFML_PRECOMPRESS_ZSTD_LEVEL", 15)),
+    "br": int(os.getenv("SFML_PRECOMPRESS_BROTLI_LEVEL", 9)),
+    "gzip": int(os.getenv("SFML_PRECOMPRESS_GZIP_LEVEL", 9)),
+}
+
+# Chunks larger than this are compressed in a worker thread to keep the event loop free.
+THREAD_THRESHOLD = 256 * 1024
+
+COMPRESSIBLE_TYPES = (
+    "text/",
+    "application/json",
+    "application/geo+json",
+)
+
+
+class _GzipCompressor:
+    def __init__(self, level: int):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data)
+
+    def finish(self) -> bytes:
+        return self._compressor.flush()
+
+
+class _BrotliCompressor:
+    def __init__(self, level: int):
+        self._compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.process(data)
+
+    def finish(self) -> bytes:
+        return self._compressor.finish()
+
+
+class _ZstdCompressor:
+    def __init__(self, level: int):
+        self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data)
+
+    def finish(self) -> bytes:
+        return self._compressor.flush()
+
+
+# Ordered by server preference, used to break ties between equal q-values.
+COMPRESSORS = {"gzip": _GzipCompressor}
+if brotli is not None:
+    COMPRESSORS = {"br": _BrotliCompressor, **COMPRESSORS}
+if zstandard is not None:
+    COMPRESSORS = {"zstd": _ZstdCompressor, **COMPRESSORS}
+
+
+def negotiate_encoding(accept_encoding: str) -> str | None:
+    """Pick the best available content coding for an `Accept-Encoding` header,
+    or None if the response should be sent uncompressed."""
+    weights = {}
+    for token in accept_encoding.lower().split(","):
+        coding, _, params = token.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                continue
+        weights[coding.strip()] = q
+
+    best, best_q = None, 0.0
+    for coding in COMPRESSORS:
+        q = weights.get(coding, weights.get("*", 0.0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+def compress(data: bytes, encoding: str, level: int | None = None) -> bytes:
+    compressor = COMPRESSORS[encoding](LEVELS[encoding] if level is None else level)
+    return compressor.compress(data) + compressor.finish()
+
+
+def precompress(body: bytes, minimum_size: int = MINIMUM_SIZE) -> dict[str, bytes]:
+    """Encode a body once with every available coding so it can be served
+    without per-request compression."""
+    bodies = {"identity": body}
+    if len(body) >= minimum_size:
+        for encoding in COMPRESSORS:
+            bodies[encoding] = compress(body, encoding, PRECOMPRESS_LEVELS[encoding])
+    return bodies
+
+
+class PrecompressedCache:
+    """A small LRU of response bodies keyed by whatever identifies their content,
+    each stored in every available content coding."""
+
+    def __init__(self, maxsize: int = 64):
+        self.maxsize = maxsize
+        self._bodies: OrderedDict[Hashable, dict[str, bytes]] = OrderedDict()
+        self._pending: dict[Hashable, asyncio.Task] = {}
+
+    def get(self, key: Hashable) -> dict[str, bytes] | None:
+        try:
+            self._bodies.move_to_end(key)
+        except KeyError:
+            return None
+        return self._bodies[key]
+
+    async def put(self, key: Hashable, body: bytes) -> dict[str, bytes]:
+        bodies = await anyio.to_thread.run_sync(precompress, body)
+        self._bodies[key] = bodies
+        self._bodies.move_to_end(key)
+        while len(self._bodies) > self.maxsize:
+            self._bodies.popitem(last=False)
+        return bodies
+
+    async def get_or_build(
+        self, key: Hashable, build: Callable[[], Awaitable[tuple[bytes, bool]]]
+    ) -> dict[str, bytes]:
+        """Return the cached bodies for `key`, or build them. `build` returns a body and whether it may be
+        cached. Concurrent misses for the same key share one build instead of each running their own.
+        """
+        bodies = self.get(key)
+        if bodies is not None:
+            return bodies
+
+        task = self._pending.get(key)
+        if task is None:
+            task = asyncio.create_task(self._build(key, build))
+            self._pending[key] = task
+            task.add_done_callback(lambda _: self._pending.pop(key, None))
+        # Shielded so one client disconnecting doesn't cancel the build for everyone else waiting on it.
+        return await asyncio.shield(task)
+
+    async def _build(
+        self, key: Hashable, build: Callable[[], Awaitable[tuple[bytes, bool]]]
+    ) -> dict[str, bytes]:
+        body, cache = await build()
+        if cache:
+            return await self.put(key, body)
+        return await anyio.to_thread.run_sync(precompress, body)
+
+    def clear(self) -> None:
+        self._bodies.clear()
+
+
+def precompressed_response(
+    request: Request,
+    bodies: dict[str, bytes],
+    media_type: str,
+    headers: dict[str, str] | None = None,
+) -> Response:
+    encoding = negotiate_encoding(request.headers.get("accept-encoding", ""))
+    headers = {**(headers or {}), "Vary": "Accept-Encoding"}
+    if encoding in bodies:
+        headers["Content-Encoding"] = encoding
+    else:
+        encoding = "identity"
+    return Response(content=bodies[encoding], media_type=media_type, headers=headers)
+
+
+class CompressionMiddleware:
+    """Compress responses with the best coding the client accepts. Streaming
+    bodies are compressed chunk by chunk as they are sent, and responses that
+    already carry a `Content-Encoding` (e.g. precompressed bodies) pass through."""
+
+    def __init__(self, app: ASGIApp, minimum_size: int = MINIMUM_SIZE) -> None:
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        encoding = negotiate_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        responder = _CompressionResponder(self.app, encoding, self.minimum_size)
+        await responder(scope, receive, send)
+
+
+class _CompressionResponder:
+    def __init__(self, app: ASGIApp, encoding: str, minimum_size: int) -> None:
+        self.app = app
+        self.encoding = encoding
+        self.minimum_size = minimum_size
+        self.send: Send = None
+        self.start_message: Message | None = None
+        self.compressor = None
+        self.passthrough = False
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        self.send = send
+        await self.app(scope, receive, self.send_compressed)
+
+    async def _compress(self, data: bytes) -> bytes:
+        if len(data) > THREAD_THRESHOLD:
+            return await anyio.to_thread.run_sync(self.compressor.compress, data)
+        return self.compressor.compress(data)
+
+    async def send_compressed(self, message: Message) -> None:
+        if message["type"] == "http.response.start":
+            self.start_message = message
+            return
+
+        if message["type"] != "http.response.body" or self.passthrough:
+            await self.send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+
+        if self.compressor is None:
+            headers = MutableHeaders(raw=self.start_message["headers"])
+            content_type = headers.get("content-type", "")
+            if (
+                "content-encoding" in headers
+                or not content_type.startswith(COMPRESSIBLE_TYPES)
+                or (not more_body and len(body) < self.minimum_size)
+            ):
+                self.passthrough = True
+                await self.send(self.start_message)
+                await self.send(message)
+                return
+
+            self.compressor = COMPRESSORS[self.encoding](LEVELS[self.encoding])
+            headers["Content-Encoding"] = self.encoding
+            headers.add_vary_header("Accept-Encoding")
+
+            if not more_body:
+                body = await self._compress(body) + self.compressor.finish()
+                headers["Content-Length"] = str(len(body))
+                await self.send(self.start_message)
+                await self.send({"type": "http.response.body", "body": body})
+                return
+
+            del headers["Content-Length"]
+            await self.send(self.start_message)
+
+        body = await self._compress(body)
+        if not more_body:
+            body += self.compressor.finish()
+        await self.send(
+            {"type": "http.response.body", "body": body, "more_body": more_body}
+        )
@@ -1,6 +1,6 @@
 from fastapi import HTTPException
 from streamflow_ml.api import schemas
-from streamflow_ml.db import basins
+from streamflow_ml.db import DateRanges, TierRegistry, basins
 import polars as pl
 import geopandas as gpd
 import datetime as dt
@@ -39,14 +39,32 @@ AGGREGATIONS = {
 }
 
 
+def _ensemble_quantile(q: float) -> pl.Expr:
+    # Same "nearest" interpolation as pl.quantile, taken from each row's sorted ensemble.
+    values = pl.col("values").list.drop_nulls()
+    index = ((values.list.len() - 1) * q).round().cast(pl.Int64)
+    return values.list.sort().list.get(index)
+
+
+# Row-wise equivalents of AGGREGATIONS for frames holding the whole ensemble in a `values` list.
+ENSEMBLE_AGGREGATIONS = {
+    "min": pl.col("values").list.min().alias("min"),
+    "max": pl.col("values").list.max().alias("max"),
+    "mean": pl.col("values").list.mean().alias("mean"),
+    "median": pl.col("values").list.median().alias("median"),
+    "iqr": (_ensemble_quantile(0.75) - _ensemble_quantile(0.25)).alias("iqr"),
+    "stddev": pl.col("values").list.std().alias("stddev"),
+}
+
+
 def calc_cfs(dat: pl.DataFrame, basins: gpd.GeoDataFrame) -> pl.DataFrame:
     query_basins = basins[basins["location"].isin(dat["location"].unique().to_list())]
     query_basins = pl.from_pandas(query_basins.drop(columns="geometry"))
+    # Either one `value` per row, or the whole ensemble in a `values` list.
+    value = "values" if "values" in dat.columns else "value"
     return (
         dat.join(query_basins, on="location")
-        .with_columns(
-            value=pl.col("value") / 86400 / 304.8 * (pl.col("area") * 10.7639)
-        )
+        .with_columns(pl.col(value) / 86400 / 304.8 * (pl.col("area") * 10.7639))
         .drop("area")
     )
 
@@ -56,8 +74,14 @@ async def aggregate_dfs(
     predictions: schemas.GetPredictionsByLocations | schemas.GetLatestPredictions,
 ) -> pl.DataFrame:
     try:
-        agg_funcs = [AGGREGATIONS[x.value] for x in predictions.aggregations]
-        dat = dat.group_by("location", "version", "date").agg(*agg_funcs)
+        if "values" in dat.collect_schema().names():
+            agg_funcs = [
+                ENSEMBLE_AGGREGATIONS[x.value] for x in predictions.aggregations
+            ]
+            dat = dat.select("location", "version", "date", *agg_funcs)
+        else:
+            agg_funcs = [AGGREGATIONS[x.value] for x in predictions.aggregations]
+            dat = dat.group_by("location", "version", "date").agg(*agg_funcs)
         dat = dat.melt(
             id_vars=["location", "version", "date"],
             value_vars=[agg_func.value for agg_func in predictions.aggregations],
@@ -71,12 +95,11 @@ async def aggregate_dfs(
     return dat
 
 
-async def read_predictions(
-    predictions: schemas.GetPredictionsByLocations,
-    location_frame: pl.LazyFrame,
-    time_frame: pl.LazyFrame,
-) -> pl.DataFrame:
-    today = dt.date.today()
+def resolve_locations(predictions: schemas.Locations) -> list[str] | None:
+    locations = predictions.locations
+    if isinstance(locations, str):
+        locations = [locations]
+
     if predictions.latitude and predictions.longitude:
         points = gpd.GeoDataFrame(
             geometry=gpd.points_from_xy(
@@ -91,7 +114,71 @@ async def read_predictions(
             )
 
         new_locs = filtered_basins["location"].values.tolist()
-        predictions.locations = list(set(predictions.locations or []) | set(new_locs))
+        locations = list(set(locations or []) | set(new_locs))
+
+    return locations
+
+
+def get_availability(
+    locations: list[str] | None,
+    version: schemas.Version | None,
+    registry: TierRegistry,
+) -> pl.DataFrame:
+    dat = registry.availability(locations, None if version is None else version.value)
+    if locations is not None:
+        missing = sorted(set(locations) - set(dat["location"].to_list()))
+        if missing:
+            raise HTTPException(
+                404, f"No predictions found for location(s): {', '.join(missing)}."
+            )
+
+    return dat.rename({"min_date": "date_start", "max_date": "date_end"})
+
+
+def route_filter(pieces: dict[DateRanges, list[str]]) -> pl.Expr:
+    return pl.any_horizontal(
+        pl.col("location").is_in(locations)
+        & pl.any_horizontal(
+            pl.col("date").is_between(start, end) for start, end in ranges
+        )
+        for ranges, locations in pieces.items()
+    )
+
+
+def scan_tiers(
+    registry: TierRegistry,
+    locations: list[str] | None,
+    version: str,
+    date_start: dt.date,
+    date_end: dt.date,
+    ensemble: bool,
+) -> list[pl.LazyFrame]:
+    # Each tier only reads the locations and dates that aren't covered by a tier before it.
+    frames = []
+    for tier, pieces in registry.route(locations, version, date_start, date_end):
+        ranges = [r for rs in pieces for r in rs]
+        frames.append(
+            tier.scan(
+                [loc for locs in pieces.values() for loc in locs],
+                min(start for start, _ in ranges),
+                max(end for _, end in ranges),
+                ensemble,
+            ).filter(pl.col("version").eq(version), route_filter(pieces))
+        )
+
+    if not frames:
+        tier = registry.tiers[0]
+        frames.append((tier.ensemble() if ensemble else tier()).clear())
+    return frames
+
+
+def validate_predictions(
+    predictions: schemas.GetPredictionsByLocations | schemas.GetPredictionsRaw,
+    registry: TierRegistry,
+) -> pl.DataFrame:
+    """Resolve the requested locations and check them against the index, so bad requests fail before being
+    queued or read. Returns each location's availability."""
+    predictions.locations = resolve_locations(predictions)
 
     if len(predictions.locations) > 20:
         raise HTTPException(
@@ -99,64 +186,92 @@ async def read_predictions(
             detail="Too many locations requested. The maximum allowed is 20.",
         )
 
-    if predictions.date_start.year < today.year:
-        hist_preds = location_frame.filter(
-            pl.col("location").is_in(predictions.locations),
-            pl.col("date").le(predictions.date_end),
-            pl.col("date").ge(predictions.date_start),
-            pl.col("version").eq(predictions.version),
-        )
-    else:
-        hist_preds = pl.LazyFrame(
-            {
-                "location": pl.Series(name="location", values=[], dtype=pl.String),
-                "date": pl.Series(name="date", values=[], dtype=pl.Date),
-                "version": pl.Series(name="version", values=[], dtype=pl.String),
-                "value": pl.Series(name="value", values=[], dtype=pl.Float64),
-                "model_no": pl.Series(name="model_no", values=[], dtype=pl.Int32),
-            }
-        )
+    # Unknown basins fail here, before anything is scanned.
+    return get_availability(predictions.locations, predictions.version, registry)
 
-    if (
-        predictions.date_end.year >= today.year
-        or predictions.date_start.year >= today.year
-    ):
-        curr_preds = time_frame.filter(
-            pl.col("location").is_in(predictions.locations),
-            pl.col("date").le(predictions.date_end),
-            pl.col("date").ge(predictions.date_start),
-            pl.col("version").eq(predictions.version),
-        )
-    else:
-        curr_preds = pl.LazyFrame(
-            {
-                "location": pl.Series(name="location", values=[], dtype=pl.String),
-                "date": pl.Series(name="date", values=[], dtype=pl.Date),
-                "version": pl.Series(name="version", values=[], dtype=pl.String),
-                "value": pl.Series(name="value", values=[], dtype=pl.Float64),
-                "model_no": pl.Series(name="model_no", values=[], dtype=pl.Int32),
-            }
-        )
 
-    hist_preds = await aggregate_dfs(hist_preds, predictions)
-    curr_preds = await aggregate_dfs(curr_preds, predictions)
-    dat = pl.concat([hist_preds, curr_preds], how="align")
+async def read_predictions(
+    predictions: schemas.GetPredictionsByLocations | schemas.GetPredictionsRaw,
+    registry: TierRegistry,
+) -> pl.DataFrame:
+    """Read predictions that have already been through `validate_predictions`."""
+    # Aggregations and the wide raw layout both work on one row per ensemble, which is how the
+    # ensemble partitions are stored, rather than exploding it into a row per model.
+    wide = getattr(predictions, "layout", None) == schemas.Layout.WIDE
+    frames = scan_tiers(
+        registry,
+        predictions.locations,
+        predictions.version.value,
+        predictions.date_start,
+        predictions.date_end,
+        ensemble=wide or isinstance(predictions, schemas.Aggregations),
+    )
+    dat = pl.concat(
+        [await aggregate_dfs(frame, predictions) for frame in frames],
+        # Tiers never return the same rows, and list columns can't be aligned on.
+        how="vertical" if wide else "align",
+    )
 
     if predictions.units.value == "cfs":
         dat = calc_cfs(dat, basins)
 
     try:
-        dat = dat.sort("location", "model_no", "version", "date")
+        dat = dat.sort("location", "model_no", "version", "date", maintain_order=True)
     except pl.exceptions.ColumnNotFoundError:
-        dat = dat.sort("location", "version", "date")
+        dat = dat.sort("location", "version", "date", maintain_order=True)
+    if wide:
+        return dat.with_columns(pl.col("values").list.eval(pl.element().round(4)))
     return dat.with_columns(pl.col("value").round(4))
 
 
+def widen_models(dat: pl.DataFrame, n_models: int) -> pl.DataFrame:
+    """Split the ensemble `values` list into a column per model. Any other columns (e.g. the basin `name`
+    added with cfs units) are kept ahead of the model columns."""
+    model_cols = [f"model_{i}" for i in range(n_models)]
+    dat = dat.with_columns(pl.col("values").list.to_struct(fields=model_cols)).unnest(
+        "values"
+    )
+    # Every model gets a column, even when no rows (or none of a model's rows) were found.
+    dat = dat.with_columns(
+        pl.lit(None, pl.Float64).alias(col)
+        for col in model_cols
+        if col not in dat.columns
+    )
+    keys = [col for col in dat.columns if col not in model_cols]
+    return dat.select(*keys, *model_cols)
+
+
+def get_latest_date(registry: TierRegistry) -> dt.date | None:
+    # Tiers without any data yet (e.g. the current year on January 1st) have no max_date.
+    dates = [tier.availability()["max_date"].max() for tier in registry.tiers]
+    return max((d for d in dates if d is not None), default=None)
+
+
+def require_latest_date(registry: TierRegistry) -> dt.date:
+    max_date = get_latest_date(registry)
+    if max_date is None:
+        raise HTTPException(404, "No predictions are available yet.")
+    return max_date
+
+
 async def get_latest_predictions(
-    frame: pl.LazyFrame, predictions: schemas.GetLatestPredictions
+    registry: TierRegistry,
+    predictions: schemas.GetLatestPredictions,
+    max_date: dt.date | None = None,
 ) -> pl.DataFrame:
-    max_date = frame.select(pl.col("date").max()).collect()[0, 0]
-    dat = frame.filter(pl.col("date") == max_date)
-    dat = await aggregate_dfs(dat, predictions)
+    if max_date is None:
+        max_date = require_latest_date(registry)
+
+    versions = pl.concat(
+        [tier.availability()["version"] for tier in registry.tiers]
+    ).unique()
+    frames = [
+        frame
+        for version in versions
+        for frame in scan_tiers(registry, None, version, max_date, max_date, True)
+    ]
+    dat = pl.concat(
+        [await aggregate_dfs(frame, predictions) for frame in frames], how="align"
+    )
     dat = dat.sort("location")
     return dat.with_columns(pl.col("value").round(4))
@@ -2,14 +2,20 @@ from typing import Annotated
 from urllib.parse import parse_qs as parse_query_string
 from urllib.parse import urlencode as encode_query_string
 
-from fastapi import FastAPI, Request, Depends, status, Query, Response
-from fastapi.responses import RedirectResponse
+from fastapi import FastAPI, Request, Depends, status, Query, Path, Response
+from fastapi.responses import PlainTextResponse, RedirectResponse
 from fastapi.security.api_key import APIKeyHeader
-from streamflow_ml.db import pq_date_partition, pq_location_partition
+from streamflow_ml.db import N_MODELS, basins, tiers
 from streamflow_ml.api import crud, schemas
+from streamflow_ml.api.admission import AdmissionController, estimate_cost
+from streamflow_ml.api.compression import (
+    CompressionMiddleware,
+    PrecompressedCache,
+    precompressed_response,
+)
+from streamflow_ml.api import tiles as vector_tiles
 from fastapi.exceptions import HTTPException
 import os
-import polars as pl
 from starlette.types import ASGIApp, Receive, Scope, Send
 
 
@@ -76,6 +82,11 @@ app = FastAPI(
 )
 
 app.add_middleware(QueryStringFlatteningMiddleware)
+app.add_middleware(CompressionMiddleware)
+
+latest_cache = PrecompressedCache()
+admission = AdmissionController()
+tile_cache = vector_tiles.TileCache(basins)
 
 
 @app.get("/", include_in_schema=False)
@@ -83,12 +94,31 @@ async def get_root(request: Request):
     return RedirectResponse("/streamflow-api/docs")
 
 
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    return PlainTextResponse(
+        admission.metrics(), media_type="text/plain; version=0.0.4"
+    )
+
+
+@app.get("/availability", tags=["Get Streamflow Data"])
+@app.get("/availability/", include_in_schema=False)
+async def get_availability(
+    availability: Annotated[schemas.GetAvailability, Query()],
+) -> schemas.ReturnAvailability:
+    """Get the first and last date with streamflow predictions for each location and model version. Locations
+    without any predictions return a 404 rather than an empty result.
+    """
+    locations = crud.resolve_locations(availability)
+    data = crud.get_availability(locations, availability.version, tiers)
+    out_dict = {col: data[col].to_list() for col in data.columns}
+    return schemas.ReturnAvailability(**out_dict)
+
+
 @app.get("/predictions", tags=["Get Streamflow Data"])
 @app.get("/predictions/", include_in_schema=False)
 async def get_predictions(
     predictions: Annotated[schemas.GetPredictionsByLocations, Query()],
-    location_frame: Annotated[pl.LazyFrame, Depends(pq_location_partition)],
-    date_frame: Annotated[pl.LazyFrame, Depends(pq_date_partition)],
 ) -> schemas.ReturnPredictions:
     """Get streamflow predictions for a given location and date range. Data is aggregated across all 10 k-fold
     models using median as the default aggregation function. Other aggregation functions can be specified using the
@@ -103,7 +133,9 @@ async def get_predictions(
             422,
             "Either the `locations` or `latitude` and `longitude` query parameters must be specified to retrieve data.",
         )
-    data = await crud.read_predictions(predictions, location_frame, date_frame)
+    availability = crud.validate_predictions(predictions, tiers)
+    async with admission.admit(estimate_cost(predictions, availability)):
+        data = await crud.read_predictions(predictions, tiers)
     if predictions.as_csv:
         return Response(
             content=data.write_csv(),
@@ -121,11 +153,10 @@ async def get_predictions(
 @app.get("/predictions/raw/", include_in_schema=False)
 async def get_predictions_raw(
     predictions: Annotated[schemas.GetPredictionsRaw, Query()],
-    location_frame: Annotated[pl.LazyFrame, Depends(pq_location_partition)],
-    date_frame: Annotated[pl.LazyFrame, Depends(pq_date_partition)],
-) -> schemas.RawReturnPredictions:
+) -> schemas.RawReturnPredictions | schemas.WideRawReturnPredictions:
     """Get streamflow predictions for a given location and date range. This endpoint returns the raw predictions
-    from the 10 k-fold models without any aggregation.
+    from the 10 k-fold models without any aggregation. With `layout=wide`, each location and date is returned once
+    with the values from all models side by side.
     """
     if (
         predictions.locations is None
@@ -136,8 +167,13 @@ async def get_predictions_raw(
             422,
             "Either the `locations` or `latitude` and `longitude` query parameters must be specified to retrieve data.",
         )
-    data = await crud.read_predictions(predictions, location_frame, date_frame)
+    availability = crud.validate_predictions(predictions, tiers)
+    async with admission.admit(estimate_cost(predictions, availability)):
+        data = await crud.read_predictions(predictions, tiers)
+
     if predictions.as_csv:
+        if predictions.layout == schemas.Layout.WIDE:
+            data = crud.widen_models(data, N_MODELS)
         return Response(
             content=data.write_csv(),
             media_type="text/csv",
@@ -146,6 +182,15 @@ async def get_predictions_raw(
             },
         )
 
+    if predictions.layout == schemas.Layout.WIDE:
+        return schemas.WideRawReturnPredictions(
+            location=data["location"].to_list(),
+            date=data["date"].to_list(),
+            version=data["version"].to_list(),
+            model_no=list(range(N_MODELS)),
+            value=data["values"].to_list(),
+        )
+
     out_dict = {col: data[col].to_list() for col in data.columns}
     return schemas.RawReturnPredictions(**out_dict)
 
@@ -153,22 +198,69 @@ async def get_predictions_raw(
 @app.get("/predictions/latest", tags=["Get Streamflow Data"])
 @app.get("/predictions/latest/", include_in_schema=False)
 async def get_latest_predictions(
+    request: Request,
     predictions: Annotated[schemas.GetLatestPredictions, Query()],
-    frame: Annotated[pl.LazyFrame, Depends(pq_date_partition)],
 ):
     """Get the latest streamflow predictions for all locations. Data is aggregated across all 10 k-fold models using
     median as the default aggregation function. Other aggregation functions can be specified using the `aggregations`
     query parameter.
     """
-    data = await crud.get_latest_predictions(frame, predictions)
+    max_date = crud.require_latest_date(tiers)
+    # The date alone isn't enough: the index can be synced ahead of the partitions it describes, so the
+    # same date can first be read with missing data and again after the next rescan.
+    key = (
+        max_date,
+        tiers.generation,
+        tuple(x.value for x in predictions.aggregations),
+        predictions.as_csv,
+    )
     if predictions.as_csv:
-        return Response(
-            content=data.write_csv(),
-            media_type="text/csv",
-            headers={
-                "Content-Disposition": f"attachment; filename=latest_flow_{str(data['date'][0]).replace('-', '')}_predictions.csv"
-            },
+        media_type = "text/csv"
+        headers = {
+            "Content-Disposition": f"attachment; filename=latest_flow_{str(max_date).replace('-', '')}_predictions.csv"
+        }
+    else:
+        media_type = "application/json"
+        headers = {}
+
+    async def build() -> tuple[bytes, bool]:
+        async with admission.admit(len(basins) * N_MODELS):
+            data = await crud.get_latest_predictions(tiers, predictions, max_date)
+        if predictions.as_csv:
+            body = data.write_csv().encode("utf-8")
+        else:
+            out_dict = {col: data[col].to_list() for col in data.columns}
+            body = (
+                schemas.ReturnPredictions(**out_dict).model_dump_json().encode("utf-8")
+            )
+        # An empty result most likely means the data for the latest date hasn't arrived yet, so don't hold
+        # on to it.
+        return body, not data.is_empty()
+
+    bodies = await latest_cache.get_or_build(key, build)
+    return precompressed_response(request, bodies, media_type, headers)
+
+
+@app.get("/tiles/{z}/{x}/{y}.mvt", tags=["Get Streamflow Data"])
+async def get_tile(
+    request: Request,
+    z: Annotated[int, Path(ge=0)],
+    x: Annotated[int, Path(ge=0)],
+    y: Annotated[int, Path(ge=0)],
+):
+    """Get a Mapbox Vector Tile of basin boundaries with the latest streamflow predictions (in mm/day) attached
+    to each basin as properties. Tiles use the web mercator (XYZ) scheme and are available up to zoom level
+    `SFML_TILE_MAX_ZOOM`, so clients should overzoom past it. Tiles without any basins return a 204.
+    """
+    if vector_tiles.mapbox_vector_tile is None:
+        raise HTTPException(
+            501,
+            "Vector tiles require the `tiles` extra (mapbox-vector-tile) to be installed.",
         )
+    if not tile_cache.min_zoom <= z <= tile_cache.max_zoom or x >= 2**z or y >= 2**z:
+        raise HTTPException(404, f"Tile {z}/{x}/{y} does not exist.")
 
-    out_dict = {col: data[col].to_list() for col in data.columns}
-    return schemas.ReturnPredictions(**out_dict)
+    bodies = await tile_cache.get(tiers, z, x, y)
+    if bodies is None:
+        return Response(status_code=204)
+    return precompressed_response(request, bodies, vector_tiles.MEDIA_TYPE)
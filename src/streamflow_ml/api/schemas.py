@@ -22,6 +22,11 @@ class Version(Enum):
     VPUB2025 = "vPUB2025"
 
 
+class Layout(Enum):
+    LONG = "long"
+    WIDE = "wide"
+
+
 class AggregationTypes(Enum):
     MIN = "min"
     MAX = "max"
@@ -155,7 +160,20 @@ class GetLatestPredictions(Aggregations):
     )
 
 
-class GetPredictionsRaw(GetPredictionsBase, Locations): ...
+class GetAvailability(Locations):
+    version: Version | None = Field(
+        None,
+        description="Model version to check. If not specified, all versions are returned.",
+        title="Model Version",
+    )
+
+
+class GetPredictionsRaw(GetPredictionsBase, Locations):
+    layout: Layout = Field(
+        Layout.LONG,
+        description="Layout of the returned data. `long` returns one row per model, `wide` returns one row per location and date with a value for each model.",
+        title="Layout",
+    )
 
 
 class GetPredictionsByLocations(GetPredictionsBase, Locations, Aggregations): ...
@@ -172,6 +190,17 @@ class RawReturnPredictions(BaseModel):
         from_attributes = True
 
 
+class WideRawReturnPredictions(BaseModel):
+    location: list[str]
+    date: list[date]
+    version: list[str]
+    model_no: list[int]
+    value: list[list[float | None]]
+
+    class Config:
+        from_attributes = True
+
+
 class ReturnPredictions(BaseModel):
     location: list[str]
     date: list[date]
@@ -183,6 +212,17 @@ class ReturnPredictions(BaseModel):
         from_attributes = True
 
 
+class ReturnAvailability(BaseModel):
+    location: list[str]
+    version: list[str]
+    date_start: list[date]
+    date_end: list[date]
+    n_rows: list[int]
+
+    class Config:
+        from_attributes = True
+
+
 class Geometry(BaseModel):
     type: Literal[
         "Point",
@@ -0,0 +1,249 @@
+import asyncio
+import datetime as dt
+import logging
+import os
+import shutil
+import time
+from pathlib import Path
+
+import anyio.to_thread
+import geopandas as gpd
+import polars as pl
+import shapely
+
+from fastapi.exceptions import HTTPException
+from streamflow_ml.api import crud, schemas
+from streamflow_ml.api.compression import precompress
+from streamflow_ml.db import TierRegistry
+
+try:
+    import mapbox_vector_tile
+except ImportError:
+    mapbox_vector_tile = None
+
+
+MEDIA_TYPE = "application/vnd.mapbox-vector-tile"
+LAYER = "basins"
+EXTENT = 4096
+BUFFER = 64  # in tile units, so polygons don't show seams along tile edges
+WORLD = 20037508.342789244  # half the width of the web mercator world, in meters
+
+MIN_ZOOM = int(os.getenv("SFML_TILE_MIN_ZOOM", 0))
+MAX_ZOOM = int(os.getenv("SFML_TILE_MAX_ZOOM", 8))
+TILE_DIR = os.getenv("SFML_TILE_DIR")
+# Seconds to wait before trying again after tiles failed to render, or were rendered from incomplete data.
+RETRY_INTERVAL = int(os.getenv("SFML_TILE_RETRY_INTERVAL", 60))
+
+logger = logging.getLogger(__name__)
+
+
+def tile_bounds(z: int, x: int, y: int) -> tuple[float, float, float, float]:
+    size = 2 * WORLD / 2**z
+    minx = -WORLD + x * size
+    maxy = WORLD - y * size
+    return minx, maxy - size, minx + size, maxy
+
+
+def render_tiles(
+    geometries: shapely.lib.Geometry,
+    properties: list[dict],
+    min_zoom: int = MIN_ZOOM,
+    max_zoom: int = MAX_ZOOM,
+) -> dict[tuple[int, int, int], bytes]:
+    """Encode every non-empty tile from `min_zoom` to `max_zoom`. Geometries must be in EPSG:3857 and are
+    simplified to roughly half a screen pixel at each zoom level."""
+    tiles = {}
+    for z in range(min_zoom, max_zoom + 1):
+        n = 2**z
+        size = 2 * WORLD / n
+        buffer = size * BUFFER / EXTENT
+        simplified = shapely.simplify(geometries, size / 512, preserve_topology=True)
+        tree = shapely.STRtree(simplified)
+        minx, miny, maxx, maxy = shapely.total_bounds(simplified)
+
+        for x in range(
+            max(int((minx + WORLD) // size), 0),
+            min(int((maxx + WORLD) // size), n - 1) + 1,
+        ):
+            for y in range(
+                max(int((WORLD - maxy) // size), 0),
+                min(int((WORLD - miny) // size), n - 1) + 1,
+            ):
+                bounds = tile_bounds(z, x, y)
+                idx = tree.query(shapely.box(*bounds))
+                if not len(idx):
+                    continue
+
+                clipped = shapely.clip_by_rect(
+                    simplified[idx],
+                    bounds[0] - buffer,
+                    bounds[1] - buffer,
+                    bounds[2] + buffer,
+                    bounds[3] + buffer,
+                )
+                features = [
+                    {"geometry": geom, "properties": properties[i]}
+                    for i, geom in zip(idx, clipped)
+                    if geom.geom_type in ("Polygon", "MultiPolygon")
+                    and not geom.is_empty
+                ]
+                if features:
+                    tiles[(z, x, y)] = mapbox_vector_tile.encode(
+                        [{"name": LAYER, "features": features}],
+                        default_options={"quantize_bounds": bounds, "extents": EXTENT},
+                    )
+    return tiles
+
+
+def _read_tiles(directory: Path) -> dict[tuple[int, int, int], bytes]:
+    return {
+        (int(p.parent.parent.name), int(p.parent.name), int(p.stem)): p.read_bytes()
+        for p in directory.glob("*/*/*.mvt")
+    }
+
+
+def _write_tiles(directory: Path, tiles: dict[tuple[int, int, int], bytes]) -> None:
+    for (z, x, y), body in tiles.items():
+        pth = directory / str(z) / str(x) / f"{y}.mvt"
+        pth.parent.mkdir(parents=True, exist_ok=True)
+        pth.write_bytes(body)
+    # Only directories with this marker are complete and safe to load on startup.
+    (directory / ".complete").touch()
+
+
+def _prune_tiles(directory: Path, keep: Path) -> None:
+    """Remove the tiles of every date other than `keep`."""
+    for pth in directory.iterdir():
+        try:
+            dt.date.fromisoformat(pth.name)
+        except ValueError:
+            continue
+        if pth != keep and pth.is_dir():
+            shutil.rmtree(pth)
+
+
+class TileCache:
+    """Vector tiles of every basin with the latest ensemble metrics attached. All zoom levels are rendered up
+    front whenever the latest date changes, and kept in memory already compressed. If `directory` is set,
+    rendered tiles are also written there and reloaded instead of re-rendered after a restart. While a new
+    set of tiles is rendered, the previous set keeps being served.
+    """
+
+    def __init__(
+        self,
+        basins: gpd.GeoDataFrame,
+        min_zoom: int = MIN_ZOOM,
+        max_zoom: int = MAX_ZOOM,
+        directory: str | None = TILE_DIR,
+    ):
+        self.basins = basins[["location", "geometry"]].to_crs("EPSG:3857")
+        self.min_zoom = min_zoom
+        self.max_zoom = max_zoom
+        self.directory = None if directory is None else Path(directory)
+        self.latest_date: dt.date | None = None
+        # Whether the tiles hold every basin the index has predictions for on `latest_date`.
+        self.complete = False
+        self.tiles: dict[tuple[int, int, int], dict[str, bytes]] = {}
+        self._build: asyncio.Task | None = None
+        self._retry_at = 0.0
+
+    async def _properties(
+        self, registry: TierRegistry, latest_date: dt.date
+    ) -> tuple[list[dict], bool]:
+        """Each basin's properties, and whether every basin indexed for `latest_date` got its metrics."""
+        version = schemas.Version.VPUB2025.value
+        predictions = schemas.GetLatestPredictions(
+            aggregations=list(schemas.AggregationTypes)
+        )
+        latest = await crud.get_latest_predictions(registry, predictions, latest_date)
+        metrics = latest.filter(pl.col("version") == version).pivot(
+            on="metric", index=["location", "date"], values="value"
+        )
+        metrics = metrics.with_columns(pl.col("date").cast(pl.String))
+
+        by_location = {row["location"]: row for row in metrics.iter_rows(named=True)}
+        # The index can list the latest date before all of its partitions have been read in.
+        expected = registry.availability(version=version).filter(
+            pl.col("max_date") >= latest_date,
+            pl.col("location").is_in(self.basins["location"].to_list()),
+        )
+        complete = all(loc in by_location for loc in expected["location"])
+        return [
+            # Vector tiles can't hold nulls, so basins without predictions only get their ID.
+            by_location.get(loc, {"location": loc})
+            for loc in self.basins["location"]
+        ], complete
+
+    async def _rebuild(self, registry: TierRegistry, latest_date: dt.date) -> None:
+        directory = (
+            None if self.directory is None else self.directory / str(latest_date)
+        )
+        if directory is not None and (directory / ".complete").exists():
+            tiles = await anyio.to_thread.run_sync(_read_tiles, directory)
+            complete = True
+        else:
+            properties, complete = await self._properties(registry, latest_date)
+            tiles = await anyio.to_thread.run_sync(
+                render_tiles,
+                self.basins.geometry.values,
+                properties,
+                self.min_zoom,
+                self.max_zoom,
+            )
+            if not complete:
+                logger.warning(
+                    "Predictions for %s are incomplete, trying again in %s seconds.",
+                    latest_date,
+                    RETRY_INTERVAL,
+                )
+                self._retry_at = time.monotonic() + RETRY_INTERVAL
+                if self.tiles:
+                    # Better to keep serving the previous date in full than this one in part.
+                    return
+            elif directory is not None:
+                await anyio.to_thread.run_sync(_write_tiles, directory, tiles)
+
+        self.tiles = await anyio.to_thread.run_sync(
+            lambda: {key: precompress(body) for key, body in tiles.items()}
+        )
+        self.latest_date = latest_date
+        self.complete = complete
+        if complete and directory is not None:
+            await anyio.to_thread.run_sync(_prune_tiles, self.directory, directory)
+
+    async def _try_rebuild(self, registry: TierRegistry, latest_date: dt.date) -> None:
+        # Keeps serving the previous tiles if rendering fails, and waits a while before the next attempt
+        # rather than starting another full render on every request.
+        try:
+            await self._rebuild(registry, latest_date)
+        except Exception:
+            logger.exception(
+                "Rendering tiles for %s failed, trying again in %s seconds.",
+                latest_date,
+                RETRY_INTERVAL,
+            )
+            self._retry_at = time.monotonic() + RETRY_INTERVAL
+
+    async def get(
+        self, registry: TierRegistry, z: int, x: int, y: int
+    ) -> dict[str, bytes] | None:
+        latest_date = crud.get_latest_date(registry)
+        if latest_date is None:
+            # No tier has any data, so there is nothing to draw.
+            return None
+        if (
+            (latest_date != self.latest_date or not self.complete)
+            and (self._build is None or self._build.done())
+            and time.monotonic() >= self._retry_at
+        ):
+            self._build = asyncio.create_task(self._try_rebuild(registry, latest_date))
+        if not self.tiles and self._build is not None:
+            # Nothing to serve yet, so wait for the first build.
+            await asyncio.shield(self._build)
+        if not self.tiles:
+            raise HTTPException(
+                503,
+                "Tiles are not available yet.",
+                headers={"Retry-After": str(RETRY_INTERVAL)},
+            )
+        return self.tiles.get((z, x, y))
@@ -1,11 +1,42 @@
 import polars as pl
 import geopandas as gpd
+import datetime as dt
+import logging
+import os
+import threading
 import time
+from pathlib import Path
+from typing import Callable, Hashable
+
+
+# Partitions are two hive levels deep (location/version or date/version). Each holds either one
+# file per k-fold model, or a single file with the whole ensemble stored as a fixed-size list.
+FOLD_GLOB = "*/*/fold=*"
+ENSEMBLE_GLOB = "*/*/ensemble-*"
+# Per location and version coverage, written by the partition scripts next to each dataset's directory
+# (e.g. /data/flow_index.parquet). Inside it, it would break scanning the directory as a whole.
+INDEX_SUFFIX = "_index.parquet"
+
+DATA_DIR = Path(os.getenv("SFML_DATA_DIR", "/data"))
+# Size of the k-fold ensemble behind every prediction.
+N_MODELS = 10
+
+logger = logging.getLogger(__name__)
+
+
+def index_path(root: str | Path) -> Path:
+    root = Path(root)
+    return root.with_name(f"{root.name}{INDEX_SUFFIX}")
+
+
+def _parse_partition(pth: Path) -> dict[str, str]:
+    return dict(d.name.split("=", 1) for d in (pth.parent.parent, pth.parent))
 
 
 class ParquetConn:
-    def __init__(self, f):
+    def __init__(self, f, n_models=N_MODELS):
         self.f = f
+        self.n_models = n_models
         self.schema = {
             "date": pl.Date,
             "value": pl.Float64,
@@ -13,23 +44,442 @@ class ParquetConn:
             "location": pl.String,
             "version": pl.String,
         }
+        self.ensemble_schema = {
+            "date": pl.Date,
+            "values": pl.Array(pl.Float64, n_models),
+            "location": pl.String,
+            "version": pl.String,
+        }
+        self.index_schema = {
+            "location": pl.String,
+            "version": pl.String,
+            "min_date": pl.Date,
+            "max_date": pl.Date,
+            "n_rows": pl.UInt32,
+        }
         self.last_refresh = 0
         self.refresh_interval = 15 * 60  # 15 minutes in seconds
-        self.df = self._scan_parquet()
+        self.files = None
+        self.index = None
+        # Bumped on every rescan, so anything derived from the data can tell when it is stale.
+        self.generation = 0
+        self._refresh_lock = threading.Lock()
+        self._scan_parquet()
+
+    def _list_files(self) -> pl.DataFrame:
+        root = Path(self.f)
+        rows = []
+        for pattern, ensemble in ((FOLD_GLOB, False), (ENSEMBLE_GLOB, True)):
+            for p in root.glob(pattern):
+                partition = _parse_partition(p)
+                rows.append(
+                    {
+                        "path": str(p),
+                        "directory": str(p.parent),
+                        # Whatever follows the fold/ensemble prefix: "0", or e.g. "2026-0" for data
+                        # added in a separate batch (see scripts/partition.py --tag).
+                        "batch": p.name.split("-", 1)[1],
+                        "location": partition.get("location"),
+                        "date": partition.get("date"),
+                        "version": partition.get("version"),
+                        "ensemble": ensemble,
+                    }
+                )
+
+        files = pl.DataFrame(
+            rows,
+            schema={
+                "path": pl.String,
+                "directory": pl.String,
+                "batch": pl.String,
+                "location": pl.String,
+                "date": pl.String,
+                "version": pl.String,
+                "ensemble": pl.Boolean,
+            },
+        ).with_columns(pl.col("date").str.to_date())
+        # Partitions that have been converted to the ensemble layout take precedence over any
+        # fold files left behind from the same batch.
+        return files.filter(
+            pl.col("ensemble") | ~pl.col("ensemble").any().over("directory", "batch")
+        ).drop("directory", "batch")
+
+    def _frames(
+        self, files: pl.DataFrame
+    ) -> tuple[pl.LazyFrame, pl.LazyFrame, pl.LazyFrame]:
+        fold_files = files.filter(~pl.col("ensemble"))["path"].to_list()
+        ensemble_files = files.filter(pl.col("ensemble"))["path"].to_list()
+
+        long_frames, ensemble_frames, key_frames = [], [], []
+        if fold_files:
+            # Columns are kept in schema order, which is also the order of the long raw CSV.
+            folds = pl.scan_parquet(
+                fold_files, hive_partitioning=True, schema=self.schema
+            ).select(*self.schema)
+            long_frames.append(folds)
+            # Each model gets its own slot in the list, so a missing fold leaves a null rather than
+            # shifting the values after it onto the wrong models.
+            model_cols = [f"model_{i}" for i in range(self.n_models)]
+            ensemble_frames.append(
+                folds.group_by("location", "version", "date")
+                .agg(
+                    pl.col("value").filter(pl.col("model_no") == i).first().alias(col)
+                    for i, col in enumerate(model_cols)
+                )
+                .select(
+                    "location", "version", "date", values=pl.concat_list(model_cols)
+                )
+            )
+            key_frames.append(folds.select("location", "version", "date"))
+
+        if ensemble_files:
+            ensembles = pl.scan_parquet(
+                ensemble_files, hive_partitioning=True, schema=self.ensemble_schema
+            ).select("location", "version", "date", pl.col("values").arr.to_list())
+            ensemble_frames.append(ensembles)
+            key_frames.append(ensembles.select("location", "version", "date"))
+            long_frames.append(
+                ensembles.with_columns(
+                    model_no=pl.int_ranges(
+                        0, pl.col("values").list.len(), dtype=pl.Int32
+                    )
+                )
+                .explode("values", "model_no")
+                .rename({"values": "value"})
+                .select(*self.schema)
+            )
+
+        if not long_frames:
+            empty = pl.LazyFrame(schema=self.schema)
+            return (
+                empty,
+                empty.select(
+                    "location",
+                    "version",
+                    "date",
+                    values=pl.lit(None, pl.List(pl.Float64)),
+                ),
+                empty.select("location", "version", "date"),
+            )
+        return pl.concat(long_frames), pl.concat(ensemble_frames), pl.concat(key_frames)
+
+    def _read_index(self, files: pl.DataFrame, keys: pl.LazyFrame) -> pl.DataFrame:
+        index_file = index_path(self.f)
+        if index_file.exists():
+            return self._clamp_index(
+                pl.read_parquet(index_file).cast(self.index_schema), files
+            )
 
-    def _scan_parquet(self):
+        if (
+            self.index is not None
+            and self.files is not None
+            and files.equals(self.files)
+        ):
+            # Nothing changed since the index was last worked out.
+            return self.index
+
+        # No index was written alongside the data, so work it out from the partitions themselves. This reads
+        # the dates of every partition, so it is only meant as a stopgap until write_index has been run.
+        logger.warning(
+            "%s not found, building it from the partitions in %s. Run write_index from the "
+            "partition scripts to avoid this.",
+            index_file,
+            self.f,
+        )
+        return (
+            keys.group_by("location", "version")
+            .agg(
+                min_date=pl.col("date").min(),
+                max_date=pl.col("date").max(),
+                n_rows=pl.col("date").n_unique(),
+            )
+            .collect()
+            .cast(self.index_schema)
+        )
+
+    def _clamp_index(self, index: pl.DataFrame, files: pl.DataFrame) -> pl.DataFrame:
+        """Limit an index read from disk to what the listed files can hold. The index can be copied over
+        before (or without) the partitions it describes, and routing to those would find nothing.
+        """
+        dated = files.filter(pl.col("date").is_not_null())
+        if not dated.is_empty():
+            # Date partitions: only the dates that have a directory.
+            spans = dated.group_by("version").agg(
+                first=pl.col("date").min(), last=pl.col("date").max()
+            )
+            index = (
+                index.join(spans, on="version")
+                .with_columns(
+                    min_date=pl.max_horizontal("min_date", "first"),
+                    max_date=pl.min_horizontal("max_date", "last"),
+                )
+                .filter(pl.col("min_date") <= pl.col("max_date"))
+                .with_columns(
+                    pl.min_horizontal(
+                        "n_rows",
+                        (pl.col("max_date") - pl.col("min_date")).dt.total_days() + 1,
+                    )
+                )
+                .drop("first", "last")
+            )
+
+        located = files.filter(pl.col("location").is_not_null())
+        if not located.is_empty():
+            # Location partitions: only the locations that have a directory.
+            index = index.join(
+                located.select("location", "version").unique(),
+                on=["location", "version"],
+                how="semi",
+            )
+        return index.cast(self.index_schema)
+
+    def _scan_parquet(self) -> None:
         self.last_refresh = time.time()
-        return pl.scan_parquet(self.f, hive_partitioning=True, schema=self.schema)
+        files = self._list_files()
+        df, ensemble_df, keys = self._frames(files)
+        index = self._read_index(files, keys)
+        self.files, self.df, self.ensemble_df, self.index = (
+            files,
+            df,
+            ensemble_df,
+            index,
+        )
+        self.generation += 1
+
+    def _background_scan(self) -> None:
+        try:
+            self._scan_parquet()
+        finally:
+            self._refresh_lock.release()
+
+    def _refresh(self) -> None:
+        # Rescan in a thread so requests (and the event loop they run on) keep using the current files and
+        # index in the meantime. Only one rescan runs at a time.
+        if (
+            time.time() - self.last_refresh > self.refresh_interval
+            and self._refresh_lock.acquire(blocking=False)
+        ):
+            threading.Thread(target=self._background_scan, daemon=True).start()
 
     def __call__(self) -> pl.LazyFrame:
-        if time.time() - self.last_refresh > self.refresh_interval:
-            self.df = self._scan_parquet()
+        """One row per model, regardless of how the partitions are stored."""
+        self._refresh()
         return self.df
 
+    def ensemble(self) -> pl.LazyFrame:
+        """One row per location, version and date with every model's value in a `values` list."""
+        self._refresh()
+        return self.ensemble_df
+
+    def availability(self) -> pl.DataFrame:
+        """First and last date, and number of days, with predictions for each location and version."""
+        self._refresh()
+        return self.index
+
+    def scan(
+        self,
+        locations: list[str] | None = None,
+        date_start: dt.date | None = None,
+        date_end: dt.date | None = None,
+        ensemble: bool = False,
+    ) -> pl.LazyFrame:
+        """Like `__call__` or `ensemble`, but only reading the files whose partitions can hold the given
+        locations and dates. Rows still need to be filtered."""
+        self._refresh()
+        files = self.files
+        if locations is not None:
+            files = files.filter(
+                pl.col("location").is_null() | pl.col("location").is_in(locations)
+            )
+        if date_start is not None:
+            files = files.filter(
+                pl.col("date").is_null() | (pl.col("date") >= date_start)
+            )
+        if date_end is not None:
+            files = files.filter(
+                pl.col("date").is_null() | (pl.col("date") <= date_end)
+            )
+
+        long_frame, ensemble_frame, _ = self._frames(files)
+        return ensemble_frame if ensemble else long_frame
+
+
+DateRanges = tuple[tuple[dt.date, dt.date], ...]
+
+
+class TierRegistry:
+    """Datasets holding predictions for overlapping or adjacent date ranges, in order of preference. Queries
+    are routed using each dataset's index, so every location and date is read from exactly one tier: the first
+    one whose index covers it. Data can therefore be copied into a preferred tier (e.g. rolling the current
+    year into the location-partitioned store) while it is being served, and takes over once that tier's index
+    includes it.
+    """
+
+    def __init__(self, *tiers: ParquetConn):
+        self.tiers = tiers
+        self._cache: dict[Hashable, tuple[tuple[int, ...], pl.DataFrame]] = {}
+
+    @property
+    def generation(self) -> tuple[int, ...]:
+        """Changes whenever any tier has been rescanned."""
+        return tuple(tier.generation for tier in self.tiers)
+
+    def _cached(
+        self, key: Hashable, compute: Callable[[], pl.DataFrame]
+    ) -> pl.DataFrame:
+        # Only worked out again once a tier has been rescanned.
+        generation = self.generation
+        cached = self._cache.get(key)
+        if cached is None or cached[0] != generation:
+            cached = self._cache[key] = (generation, compute())
+        return cached[1]
+
+    def _coverage(self, version: str) -> pl.DataFrame:
+        """The dates each tier serves for every location, as one row per tier, location and contiguous
+        range. Every other date range is a subset of these."""
+        return self._cached(("coverage", version), lambda: self._split_tiers(version))
+
+    def _split_tiers(self, version: str) -> pl.DataFrame:
+        one_day = pl.duration(days=1)
+        # What is still unclaimed for every location seen so far. Locations start out with every date
+        # once a tier's index first lists them.
+        remaining = pl.DataFrame(
+            schema={"location": pl.String, "start": pl.Date, "end": pl.Date}
+        )
+        seen = pl.DataFrame(schema={"location": pl.String})
+        claims = []
+        for i, tier in enumerate(self.tiers):
+            index = (
+                tier.availability()
+                .filter(pl.col("version") == version)
+                .select("location", "min_date", "max_date")
+            )
+            unseen = index.join(seen, on="location", how="anti").select(
+                "location",
+                start=pl.lit(dt.date.min, pl.Date),
+                end=pl.lit(dt.date.max, pl.Date),
+            )
+            ranges = (
+                pl.concat([remaining, unseen])
+                .join(index, on="location")
+                .with_columns(
+                    lo=pl.max_horizontal("start", "min_date"),
+                    hi=pl.min_horizontal("end", "max_date"),
+                )
+            )
+            covered = pl.col("lo") <= pl.col("hi")
+            claims.append(
+                ranges.filter(covered).select(
+                    "location", tier=pl.lit(i, pl.UInt32), start="lo", end="hi"
+                )
+            )
+            # Whatever this tier doesn't cover: either the whole range, or the parts before and after it.
+            remaining = pl.concat(
+                [
+                    remaining.join(index, on="location", how="anti"),
+                    ranges.filter(~covered).select("location", "start", "end"),
+                    ranges.filter(covered, pl.col("start") < pl.col("lo")).select(
+                        "location", "start", end=pl.col("lo") - one_day
+                    ),
+                    ranges.filter(covered, pl.col("hi") < pl.col("end")).select(
+                        "location", start=pl.col("hi") + one_day, end="end"
+                    ),
+                ]
+            )
+            seen = pl.concat([seen, unseen.select("location")])
+        return pl.concat(claims).sort("tier", "location", "start")
+
+    def route(
+        self,
+        locations: list[str] | None,
+        version: str,
+        date_start: dt.date,
+        date_end: dt.date,
+    ) -> list[tuple[ParquetConn, dict[DateRanges, list[str]]]]:
+        """For each tier that has to be read, the date ranges it serves mapped to the locations they apply to."""
+        claims = self._coverage(version)
+        if locations is not None:
+            claims = claims.filter(pl.col("location").is_in(locations))
+        claims = claims.with_columns(
+            pl.max_horizontal("start", pl.lit(date_start, pl.Date)),
+            pl.min_horizontal("end", pl.lit(date_end, pl.Date)),
+        ).filter(pl.col("start") <= pl.col("end"))
+        routes = []
+        for (i,), tier_claims in claims.partition_by(
+            "tier", as_dict=True, maintain_order=True
+        ).items():
+            pieces = (
+                tier_claims.group_by("location", maintain_order=True)
+                .agg("start", "end")
+                .group_by("start", "end", maintain_order=True)
+                .agg("location")
+            )
+            routes.append(
+                (
+                    self.tiers[i],
+                    {
+                        tuple(zip(starts, ends)): locs
+                        for starts, ends, locs in pieces.iter_rows()
+                    },
+                )
+            )
+        return routes
+
+    def availability(
+        self, locations: list[str] | None = None, version: str | None = None
+    ) -> pl.DataFrame:
+        """Coverage across all tiers. Days available from more than one tier are only counted once."""
+        dat = self._cached("availability", self._availability)
+        if version is not None:
+            dat = dat.filter(pl.col("version") == version)
+        if locations is not None:
+            dat = dat.filter(pl.col("location").is_in(locations))
+        return dat
+
+    def _availability(self) -> pl.DataFrame:
+        index = pl.concat(
+            [
+                tier.availability().with_columns(tier=pl.lit(i, pl.UInt32))
+                for i, tier in enumerate(self.tiers)
+            ]
+        )
+        claims = pl.DataFrame(
+            schema={
+                "location": pl.String,
+                "tier": pl.UInt32,
+                "start": pl.Date,
+                "end": pl.Date,
+                "version": pl.String,
+            }
+        )
+        claims = pl.concat(
+            [claims]
+            + [
+                self._coverage(v).with_columns(version=pl.lit(v))
+                for v in index["version"].unique().to_list()
+            ]
+        )
+        claimed = claims.group_by("location", "version", "tier").agg(
+            claimed_days=((pl.col("end") - pl.col("start")).dt.total_days() + 1).sum()
+        )
+        return (
+            index.join(claimed, on=["location", "version", "tier"], how="left")
+            .group_by("location", "version")
+            .agg(
+                pl.col("min_date").min(),
+                pl.col("max_date").max(),
+                pl.min_horizontal("n_rows", pl.col("claimed_days").fill_null(0))
+                .sum()
+                .alias("n_rows"),
+            )
+            .sort("location", "version")
+        )
+
 
-pq_location_partition = ParquetConn(f="/data/flow")
-pq_date_partition = ParquetConn(f="/data/current")
-basins = gpd.read_file("/data/basins.geojson")
+pq_location_partition = ParquetConn(f=DATA_DIR / "flow")
+pq_date_partition = ParquetConn(f=DATA_DIR / "current")
+tiers = TierRegistry(pq_location_partition, pq_date_partition)
+basins = gpd.read_file(DATA_DIR / "basins.geojson")
 # pq_location_partition = ParquetConn(f="/home/cbrust/data/streamflow/flow")
 # pq_date_partition = ParquetConn(f="/home/cbrust/data/streamflow/current")
 # basins = gpd.read_file("/home/cbrust/data/streamflow/basins.geojson")